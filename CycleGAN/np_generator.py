@@ -0,0 +1,129 @@
+import argparse
+import numpy as np
+
+# NumPy forward pass of tf2_module.build_generator, for weights written by tf2_model.CycleGAN.export_generators;
+# it imports neither TensorFlow nor any tf2_ module, so nothing is built or restored before the first phrase
+
+
+def load_generator(npz_path):
+    """Generator weights of an exported .npz, keyed like 'CONV2D_1/kernel' or 'RESNET_BLOCK_1/CONV2D_1/kernel'"""
+    with np.load(npz_path) as f:
+        return {name: f[name].astype(np.float32) for name in f.files}
+
+
+def reflect_pad(x, p):
+    return np.pad(x, [(0, 0), (p, p), (p, p), (0, 0)], mode='reflect')
+
+
+def conv2d(x, kernel, strides=1):
+    """'VALID' convolution of (batch * h * w * c_in) with a (k * k * c_in * c_out) kernel"""
+    k = kernel.shape[0]
+    out_h = (x.shape[1] - k) // strides + 1
+    out_w = (x.shape[2] - k) // strides + 1
+    # one matmul per kernel tap, the memory of an im2col copy would grow with k * k
+    y = np.zeros((x.shape[0], out_h, out_w, kernel.shape[3]), dtype=np.float32)
+    for i in range(k):
+        for j in range(k):
+            patch = x[:, i:i + strides * (out_h - 1) + 1:strides, j:j + strides * (out_w - 1) + 1:strides, :]
+            y += patch @ kernel[i, j]
+    return y
+
+
+def conv2d_same(x, kernel, strides=1):
+    """'SAME' convolution with TensorFlow's padding, the extra row and column go after"""
+    k = kernel.shape[0]
+    pads = []
+    for size in x.shape[1:3]:
+        total = max((-(-size // strides) - 1) * strides + k - size, 0)
+        pads.append((total // 2, total - total // 2))
+    return conv2d(np.pad(x, [(0, 0)] + pads + [(0, 0)]), kernel, strides)
+
+
+def conv2d_transpose_same(x, kernel, strides=2):
+    """'SAME' transposed convolution with a (k * k * c_out * c_in) kernel, (batch * h * w * c) -> (h * strides)"""
+    k = kernel.shape[0]
+    batch, h, w, c = x.shape
+    # zeros between the inputs, then a full convolution with the flipped kernel
+    dilated = np.zeros((batch, (h - 1) * strides + 1, (w - 1) * strides + 1, c), dtype=np.float32)
+    dilated[:, ::strides, ::strides, :] = x
+    full = conv2d(np.pad(dilated, [(0, 0), (k - 1, k - 1), (k - 1, k - 1), (0, 0)]),
+                  kernel[::-1, ::-1].transpose(0, 1, 3, 2))
+    # TensorFlow crops the full output like the padding of the forward convolution
+    top = max(k - strides, 0) // 2
+    return full[:, top:top + h * strides, top:top + w * strides, :]
+
+
+def instance_norm(x, weights, name, epsilon=1e-5):
+    mean = x.mean(axis=(1, 2), keepdims=True)
+    variance = x.var(axis=(1, 2), keepdims=True)
+    return weights[name + '/SCALE'] * (x - mean) / np.sqrt(variance + epsilon) + weights[name + '/OFFSET']
+
+
+def relu(x):
+    return np.maximum(x, 0.)
+
+
+def generator_forward(weights, x):
+    """(batch * 64 * 84 * 1) -> (batch * 64 * 84 * 1); the time length may be any multiple of 4"""
+    x = np.asarray(x, dtype=np.float32)
+
+    x = relu(instance_norm(conv2d(reflect_pad(x, 3), weights['CONV2D_1/kernel']), weights, 'INSTANCE_NORM_1'))
+    # (batch * 64 * 84 * 64)
+    x = relu(instance_norm(conv2d_same(x, weights['CONV2D_2/kernel'], 2), weights, 'INSTANCE_NORM_2'))
+    # (batch * 32 * 42 * 128)
+    x = relu(instance_norm(conv2d_same(x, weights['CONV2D_3/kernel'], 2), weights, 'INSTANCE_NORM_3'))
+    # (batch * 16 * 21 * 256)
+
+    i = 1
+    while 'RESNET_BLOCK_{}/CONV2D_1/kernel'.format(i) in weights:
+        block = 'RESNET_BLOCK_{}/'.format(i)
+        y = relu(instance_norm(conv2d(reflect_pad(x, 1), weights[block + 'CONV2D_1/kernel']),
+                               weights, block + 'INSTANCE_NORM_1'))
+        y = instance_norm(conv2d(reflect_pad(y, 1), weights[block + 'CONV2D_2/kernel']),
+                          weights, block + 'INSTANCE_NORM_2')
+        x = relu(y + x)
+        i += 1
+    # (batch * 16 * 21 * 256)
+
+    x = relu(instance_norm(conv2d_transpose_same(x, weights['DECONV2D_1/kernel']), weights, 'INSTANCE_NORM_4'))
+    # (batch * 32 * 42 * 128)
+    x = relu(instance_norm(conv2d_transpose_same(x, weights['DECONV2D_2/kernel']), weights, 'INSTANCE_NORM_5'))
+    # (batch * 64 * 84 * 64)
+    x = conv2d(reflect_pad(x, 3), weights['CONV2D_4/kernel'])
+    # (batch * 64 * 84 * 1)
+
+    return 1. / (1. + np.exp(-x))
+
+
+def transfer(weights, phrases, batch_size=16):
+    """Generator outputs of (num_phrases * 64 * 84 * 1), batch_size phrases at a time"""
+    return np.concatenate([generator_forward(weights, phrases[start:start + batch_size])
+                           for start in range(0, len(phrases), batch_size)])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Style transfer of npy phrases with an exported generator')
+    parser.add_argument('--weights', dest='weights', required=True, help='generator .npz written by --phase export')
+    parser.add_argument('--input', dest='input', required=True, help='npy of phrases, (num_phrases * 64 * 84 * 1)')
+    parser.add_argument('--output', dest='output', required=True, help='npy the transferred phrases are written to')
+    parser.add_argument('--midi', dest='midi', default=None, help='also write the transferred phrases as MIDI')
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=16, help='# of phrases per forward pass')
+    args = parser.parse_args()
+
+    phrases = np.load(args.input).astype(np.float32)
+    phrases = phrases.reshape(-1, phrases.shape[-3], phrases.shape[-2], 1) if phrases.ndim == 4 \
+        else phrases.reshape(-1, 64, phrases.shape[-1], 1)
+    outputs = transfer(load_generator(args.weights), phrases, args.batch_size)
+    np.save(args.output, outputs)
+
+    if args.midi is not None:
+        import write_midi
+        # binarized and padded to the 128 MIDI pitches like tf2_utils.save_midis
+        rolls = np.pad(outputs[..., 0] > 0.5, [(0, 0), (0, 0), (24, 20)])
+        write_midi.write_piano_rolls_to_midi(piano_rolls=[rolls],
+                                             program_nums=[0],
+                                             is_drum=[False],
+                                             filename=args.midi,
+                                             tempo=80.0,
+                                             beat_resolution=4)
@@ -0,0 +1,33 @@
+import os
+import numpy as np
+
+from tf2_shards import write_shards, PhraseShards
+
+
+def write_phrases(directory, phrases):
+    os.makedirs(directory)
+    for idx, phrase in enumerate(phrases):
+        np.save(os.path.join(directory, '{}.npy'.format(idx)), phrase)
+
+
+def test_packed_and_plain_shards_concatenate(tmp_path):
+    rng = np.random.RandomState(0)
+    # binary (64 * 84 * 1) phrases, stored as float64 like the original datasets
+    phrases_A = (rng.rand(5, 64, 84, 1) > 0.9).astype(np.float64)
+    phrases_B = (rng.rand(3, 64, 84, 1) > 0.9).astype(np.float64)
+    write_phrases(str(tmp_path / 'A'), phrases_A)
+    write_phrases(str(tmp_path / 'B'), phrases_B)
+    write_shards(str(tmp_path / 'A'), str(tmp_path / 'A_packed'), shard_size=2, packed=True)
+    write_shards(str(tmp_path / 'B'), str(tmp_path / 'B_plain'), shard_size=2)
+
+    for shards, expected in [(PhraseShards(str(tmp_path / 'A_packed')) + PhraseShards(str(tmp_path / 'B_plain')),
+                              np.concatenate([phrases_A, phrases_B])),
+                             (PhraseShards(str(tmp_path / 'B_plain')) + PhraseShards(str(tmp_path / 'A_packed')),
+                              np.concatenate([phrases_B, phrases_A]))]:
+        assert len(shards) == 8
+        indices = [7, 0, 4, 5, 2]
+        batch = shards.batch(indices)
+        assert batch.dtype == np.float32
+        np.testing.assert_array_equal(batch, expected[indices])
+        for idx in range(len(shards)):
+            np.testing.assert_array_equal(shards[idx], expected[idx])
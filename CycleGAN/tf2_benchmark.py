@@ -0,0 +1,159 @@
+import os
+import re
+import sys
+import time
+import copy
+import argparse
+import subprocess
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+
+from tf2_module import ReflectPadConv2D, padding
+
+
+def time_fn(fn, inputs, iters=20, warmup=3):
+    """Average wall time of fn(*inputs) in milliseconds, after a few untimed warm-up calls"""
+    for _ in range(warmup):
+        fn(*inputs)
+    start_time = time.time()
+    for _ in range(iters):
+        result = fn(*inputs)
+    # make sure the last asynchronous op has finished before stopping the clock
+    tf.nest.map_structure(lambda t: t.numpy() if tf.is_tensor(t) else t, result)
+    return (time.time() - start_time) / iters * 1000.
+
+
+def build_lambda_conv(filters, kernel_size, initializer):
+    # the pattern build_generator used before ReflectPadConv2D
+    return tf.keras.Sequential([layers.Lambda(padding, arguments={'p': (kernel_size - 1) // 2}),
+                                layers.Conv2D(filters=filters,
+                                              kernel_size=kernel_size,
+                                              strides=1,
+                                              padding='valid',
+                                              kernel_initializer=initializer,
+                                              use_bias=False)])
+
+
+def benchmark_reflect_conv(batch_size, iters, jit_compile=False):
+    """Compare Lambda(padding) + Conv2D against ReflectPadConv2D on the generator's shapes"""
+    initializer = tf.random_normal_initializer(0., 0.02)
+    # (input shape, filters, kernel size): ResNet block conv and the full resolution output conv
+    configs = [((16, 21, 256), 256, 3),
+               ((64, 84, 64), 1, 7)]
+
+    print('%-16s %-10s %-12s %12s %12s' % ('input', 'kernel', 'layer', 'forward ms', 'fwd+bwd ms'))
+    for shape, filters, kernel_size in configs:
+        x = tf.random.uniform((batch_size,) + shape)
+        candidates = [('lambda+conv2d', build_lambda_conv(filters, kernel_size, initializer)),
+                      ('reflect_conv', ReflectPadConv2D(filters=filters,
+                                                        kernel_size=kernel_size,
+                                                        kernel_initializer=initializer))]
+        for layer_name, layer in candidates:
+            layer(x)
+
+            @tf.function(jit_compile=jit_compile)
+            def forward(inputs):
+                return layer(inputs)
+
+            @tf.function(jit_compile=jit_compile)
+            def forward_backward(inputs):
+                with tf.GradientTape() as tape:
+                    tape.watch(inputs)
+                    loss = tf.reduce_mean(layer(inputs))
+                return tape.gradient(loss, [inputs] + layer.trainable_variables)
+
+            print('%-16s %-10s %-12s %12.3f %12.3f' % ('x'.join(str(d) for d in shape),
+                                                       '%dx%d' % (kernel_size, kernel_size),
+                                                       layer_name,
+                                                       time_fn(forward, [x], iters),
+                                                       time_fn(forward_backward, [x], iters)))
+
+
+def time_train_steps(args, steps=5, warmup=2):
+    """Average wall time of a training step of the tf2_main configuration args on random phrases"""
+    # imported here, the models are only needed when probing tf2_main configurations
+    from tf2_model import CycleGAN
+    from tf2_classifier import Classifier
+
+    # discriminators and optimizers are only built for the train phase
+    args = copy.copy(args)
+    args.phase = 'train'
+
+    shape = [args.batch_size, args.time_step, args.pitch_range, args.input_nc]
+    if args.type == 'cyclegan':
+        model = CycleGAN(args)
+        model._build_train_step()
+        inputs = [tf.random.uniform(shape) for _ in range(2 if args.model == 'base' else 3)]
+        return time_fn(model.train_step, inputs, steps, warmup)
+
+    model = Classifier(args)
+    labels = tf.one_hot(tf.zeros([args.batch_size], dtype=tf.int32), 2)
+    inputs = [tf.random.uniform(shape), labels, tf.random.uniform(shape), labels]
+
+    def train_step(*step_inputs):
+        loss, accuracy, gradients = model.gradient_step(*step_inputs)
+        model.strategy.run(model._apply_gradients, args=(gradients,))
+        return loss
+
+    return time_fn(train_step, inputs, steps, warmup)
+
+
+def thread_candidates(num_workers=1):
+    """(intra_op, inter_op) thread pool sizes worth probing on this host"""
+    cores = max((os.cpu_count() or 1) // num_workers, 1)
+    intra_op = sorted({cores, max(cores // 2, 1), max(cores // 4, 1)}, reverse=True)
+    return [(intra, inter) for intra in intra_op for inter in (1, 2)]
+
+
+def run_probe(argv, steps=5):
+    """probe_* values printed by the tf2_main command argv run with --probe_steps in a new process"""
+    env = {key: value for key, value in os.environ.items() if key != 'TF_CONFIG'}
+    command = [sys.executable] + argv + ['--probe_steps', str(steps)]
+    output = subprocess.run(command, env=env, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return {key: float(value) for key, value in re.findall(r'^probe_(\w+): (\S+)$', output, re.M)}
+
+
+def autotune_threads(argv, candidates, steps=5):
+    """Time a few training steps of the tf2_main command argv per candidate, return the fastest one"""
+    # thread pools cannot be resized once TensorFlow is running, so every candidate gets its own process
+    timings = {}
+    for intra, inter in candidates:
+        result = run_probe(argv + ['--intra_op_threads', str(intra),
+                                   '--inter_op_threads', str(inter)], steps)
+        if 'ms_per_step' not in result:
+            print('intra_op_threads %3d inter_op_threads %3d: failed' % (intra, inter))
+            continue
+        timings[(intra, inter)] = result['ms_per_step']
+        print('intra_op_threads %3d inter_op_threads %3d: %10.3f ms/step' % (intra, inter, timings[(intra, inter)]))
+
+    if not timings:
+        raise RuntimeError('none of the thread configurations could be probed')
+    return min(timings, key=timings.get)
+
+
+def probe_batch_sizes(argv, batch_sizes, steps=3):
+    """Step time and peak memory of the tf2_main command argv at every batch size, e.g. with and without --recompute"""
+    # peak RSS only grows within a process, so every batch size gets its own
+    print('%10s %12s %14s %16s' % ('batch_size', 'ms/step', 'peak_rss_mb', 'ms/step/sample'))
+    for batch_size in batch_sizes:
+        result = run_probe(argv + ['--batch_size', str(batch_size)], steps)
+        if 'ms_per_step' not in result:
+            print('%10d %12s' % (batch_size, 'failed'))
+            continue
+        print('%10d %12.3f %14.1f %16.3f' % (batch_size,
+                                             result['ms_per_step'],
+                                             result.get('peak_rss_mb', float('nan')),
+                                             result['ms_per_step'] / batch_size))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Micro benchmarks for the CycleGAN building blocks')
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=16, help='# images in batch')
+    parser.add_argument('--iters', dest='iters', type=int, default=20, help='# of timed iterations')
+    parser.add_argument('--jit', dest='jit', action='store_true', help='compile the benchmarked functions with XLA')
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    benchmark_reflect_conv(args.batch_size, args.iters, args.jit)
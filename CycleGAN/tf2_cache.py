@@ -0,0 +1,131 @@
+import os
+import hashlib
+import threading
+import collections
+import numpy as np
+
+
+class PhraseCache(object):
+    """LRU memo of per-phrase outputs keyed by the binary input phrase and a tag, optionally persisted to cache_dir,
+    which keeps the max_dir_entries most recently used files, 0 leaves it unbounded"""
+
+    def __init__(self, max_entries=4096, cache_dir=None, max_dir_entries=65536):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir or None
+        self.max_dir_entries = max_dir_entries
+        self.entries = collections.OrderedDict()
+        self.dir_entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.cache_dir is not None and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        if self.cache_dir is not None:
+            # files of earlier runs, least recently used first
+            names = [name for name in os.listdir(self.cache_dir)
+                     if name.endswith('.npz') and not name.endswith('.tmp.npz')]
+            names.sort(key=lambda name: os.path.getmtime(os.path.join(self.cache_dir, name)))
+            for name in names:
+                self.dir_entries[name[:-len('.npz')]] = None
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 or self.cache_dir is not None
+
+    def key(self, phrase, tag):
+        # only binary phrases are cached, their bit-packed piano roll identifies them exactly
+        binary = phrase > 0.5
+        if not np.array_equal(binary, phrase):
+            return None
+        digest = hashlib.sha1(tag.encode())
+        digest.update(str(phrase.shape).encode())
+        digest.update(np.packbits(binary).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        value = None
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            try:
+                with np.load(self._path(key)) as f:
+                    value = tuple(f['arr_{}'.format(i)] for i in range(len(f.files)))
+                os.utime(self._path(key))
+            except FileNotFoundError:
+                # evicted in between
+                value = None
+        with self.lock:
+            if value is not None and self.cache_dir is not None:
+                self.dir_entries[key] = None
+                self.dir_entries.move_to_end(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._insert(key, value)
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._insert(key, value)
+        if self.cache_dir is not None:
+            # written under a temporary name, a concurrent reader never sees a partial file
+            tmp_path = '{}.{}.tmp.npz'.format(self._path(key)[:-len('.npz')], threading.get_ident())
+            np.savez(tmp_path, *value)
+            os.replace(tmp_path, self._path(key))
+            with self.lock:
+                self.dir_entries[key] = None
+                self.dir_entries.move_to_end(key)
+                evicted = []
+                while 0 < self.max_dir_entries < len(self.dir_entries):
+                    evicted.append(self.dir_entries.popitem(last=False)[0])
+            for old_key in evicted:
+                try:
+                    os.remove(self._path(old_key))
+                except FileNotFoundError:
+                    pass
+
+    def _insert(self, key, value):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def __call__(self, fn, phrases, tag):
+        """fn(phrases), a tuple of per-phrase batch arrays, computed for the phrases missing from the cache only"""
+        if not self.enabled or tag is None:
+            return tuple(np.asarray(output) for output in fn(phrases))
+
+        keys = [self.key(phrase, tag) for phrase in phrases]
+        values = [self.get(key) if key is not None else None for key in keys]
+
+        # repeated phrases within the batch are run once
+        missing = collections.OrderedDict()
+        for idx, (key, value) in enumerate(zip(keys, values)):
+            if value is None:
+                missing.setdefault(key if key is not None else idx, []).append(idx)
+        if missing:
+            outputs = [np.asarray(output) for output in fn(phrases[[idxs[0] for idxs in missing.values()]])]
+            for i, (key, idxs) in enumerate(missing.items()):
+                # copied, a view would keep the whole batch output alive for as long as the entry
+                value = tuple(output[i].copy() for output in outputs)
+                if isinstance(key, str):
+                    self.put(key, value)
+                for idx in idxs:
+                    values[idx] = value
+
+        return tuple(np.stack([value[i] for value in values]) for i in range(len(values[0])))
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self.entries)}
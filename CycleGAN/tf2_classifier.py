@@ -1,13 +1,16 @@
 import os
+import shutil
 import numpy as np
-from random import shuffle
 from collections import namedtuple
-from glob import glob
 import tensorflow as tf
 from tensorflow.keras.optimizers import Adam
 
-from tf2_module import build_generator, build_discriminator_classifier, softmax_criterion
-from tf2_utils import get_now_datetime, save_midis
+from tf2_module import build_generator, build_discriminator_classifier, softmax_criterion, precision_policy
+from tf2_utils import get_now_datetime, save_midis, build_phrase_dataset, async_checkpoint_options
+from tf2_shards import PhraseShards, find_phrases, phrase_name, read_phrase
+from tf2_telemetry import StepTelemetry
+from tf2_quantize import sample_phrases, quantize_int8, TFLiteModel, drift_report, write_report
+from tf2_distribute import get_strategy, num_workers, task_index, is_chief, worker_dir
 
 
 class Classifier(object):
@@ -18,6 +21,7 @@ class Classifier(object):
         self.dataset_B_dir = args.dataset_B_dir
         self.sample_dir = args.sample_dir
         self.batch_size = args.batch_size
+        self.accum_steps = args.accum_steps  # number of micro-batches per optimizer update
         self.time_step = args.time_step
         self.pitch_range = args.pitch_range
         self.input_c_dim = args.input_nc  # number of input image channels
@@ -39,136 +43,236 @@ class Classifier(object):
                                         'is_training')
         self.options = OPTIONS._make((args.batch_size,
                                       args.time_step,
-                                      args.pitch_range,
                                       args.input_nc,
                                       args.output_nc,
+                                      args.pitch_range,
                                       args.ngf,
                                       args.ndf,
                                       args.phase == 'train'))
 
         self.now_datetime = get_now_datetime()
 
-        self._build_model(args)
+        # the default strategy runs a single replica, tf2_main sets up a multi-worker one for data-parallel training
+        self.strategy = get_strategy()
+
+        with self.strategy.scope():
+            self.rng = tf.random.Generator.from_seed(args.seed)
+
+            self._build_model(args)
+
+        # compiled training and inference steps, with XLA when --xla is set
+        self.gradient_step = tf.function(self._gradient_step,
+                                         jit_compile=args.xla)
+        # a fixed input signature keeps the step from being retraced and recompiled for every batch size
+        phrase_spec = tf.TensorSpec(shape=[None, self.time_step, self.pitch_range, self.input_c_dim],
+                                    dtype=tf.float32)
+        self.classify_step = tf.function(self._classify,
+                                         input_signature=[phrase_spec],
+                                         jit_compile=args.xla)
 
         print("Initializing classifier...")
 
     def _build_model(self, args):
 
-        # build classifier
-        self.classifier = self.discriminator(self.options,
-                                             name='Classifier')
+        # build classifier, computing in float32 or bfloat16
+        with precision_policy(args.precision):
+            self.classifier = self.discriminator(self.options,
+                                                 name='Classifier')
 
-        # optimizer
-        self.classifier_optimizer = Adam(self.lr,
-                                         beta_1=args.beta1)
+        # optimizer, only needed for training
+        if self.options.is_training:
+            self.classifier_optimizer = Adam(self.lr,
+                                             beta_1=args.beta1)
 
         # checkpoints
         model_name = "classifier.model"
-        model_dir = "classifier_{}2{}_{}_{}".format(self.dataset_A_dir,
-                                                    self.dataset_B_dir,
-                                                    self.now_datetime,
-                                                    str(self.sigma_c))
+        self.model_dir = "classifier_{}2{}_{}_{}".format(self.dataset_A_dir,
+                                                         self.dataset_B_dir,
+                                                         self.now_datetime,
+                                                         str(self.sigma_c))
         self.checkpoint_dir = os.path.join(args.checkpoint_dir,
-                                           model_dir,
+                                           self.model_dir,
                                            model_name)
 
-        if not os.path.exists(self.checkpoint_dir):
-            os.makedirs(self.checkpoint_dir)
+        # the data-parallel workers may create it at the same time
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
 
-        self.checkpoint = tf.train.Checkpoint(classifier_optimizer=self.classifier_optimizer,
-                                              classifier=self.classifier)
+        if self.options.is_training:
+            self.checkpoint = tf.train.Checkpoint(classifier_optimizer=self.classifier_optimizer,
+                                                  classifier=self.classifier)
+        else:
+            # the optimizer slots of a training checkpoint are skipped on restore
+            self.checkpoint = tf.train.Checkpoint(classifier=self.classifier)
+        # every worker has to save, but only the chief writes to checkpoint_dir
         self.checkpoint_manager = tf.train.CheckpointManager(self.checkpoint,
-                                                             self.checkpoint_dir,
+                                                             worker_dir(self.checkpoint_dir),
                                                              max_to_keep=5)
 
+    def _gradient_step(self, batch_data, batch_label, data_test, label_test):
+
+        with tf.GradientTape() as tape:
+
+            # Origin samples passed through the classifier
+            origin = self.classifier(batch_data,
+                                     training=True)
+            test = self.classifier(data_test,
+                                   training=True)
+
+            # loss
+            loss = softmax_criterion(origin, batch_label)
+
+            # test accuracy
+            test_softmax = tf.nn.softmax(test)
+            test_prediction = tf.equal(tf.argmax(test_softmax, 1), tf.argmax(label_test, 1))
+            test_accuracy = tf.reduce_mean(tf.cast(test_prediction, tf.float32))
+
+        # calculate gradients
+        classifier_gradients = tape.gradient(target=loss,
+                                             sources=self.classifier.trainable_variables)
+
+        return loss, test_accuracy, classifier_gradients
+
+    def _classify(self, phrases):
+        # class probabilities of phrases in [0, 1]
+        phrases = tf.reshape(tf.cast(phrases, tf.float32), [-1, self.time_step, self.pitch_range, self.input_c_dim])
+        return tf.nn.softmax(self.classifier(phrases * 2. - 1.,
+                                             training=False))
+
+    def classify(self, phrases):
+        # class probabilities of one phrase or a batch of phrases, in any float dtype
+        phrases = np.asarray(phrases, dtype=np.float32).reshape(-1, self.time_step, self.pitch_range, self.input_c_dim)
+        return self.classify_step(phrases)
+
+    def _apply_gradients(self, gradients):
+
+        # the optimizer sums the gradients of all replicas, the loss is a mean over the local batch
+        scale = 1. / self.strategy.num_replicas_in_sync
+        self.classifier_optimizer.apply_gradients(zip([gradient * scale for gradient in gradients],
+                                                      self.classifier.trainable_variables))
+
     def train(self, args):
 
         # create training list (origin data with corresponding label)
         # Label for A is (1, 0), for B is (0, 1)
-        dataA = glob('./datasets/{}/train/*.*'.format(self.dataset_A_dir))
-        dataB = glob('./datasets/{}/train/*.*'.format(self.dataset_B_dir))
+        # Each directory may also be a packed shard directory written by tf2_shards.
+        dataA = find_phrases('./datasets/{}/train'.format(self.dataset_A_dir))
+        dataB = find_phrases('./datasets/{}/train'.format(self.dataset_B_dir))
         labelA = [(1.0, 0.0) for _ in range(len(dataA))]
         labelB = [(0.0, 1.0) for _ in range(len(dataB))]
-        data_origin = dataA + dataB
-        label_origin = labelA + labelB
-        training_list = [pair for pair in zip(data_origin, label_origin)]
+        data_train = dataA + dataB
+        label_train = labelA + labelB
         print('Successfully create training list!')
 
         # create test list (origin data with corresponding label)
-        dataA = glob('./datasets/{}/test/*.*'.format(self.dataset_A_dir))
-        dataB = glob('./datasets/{}/test/*.*'.format(self.dataset_B_dir))
+        dataA = find_phrases('./datasets/{}/test'.format(self.dataset_A_dir))
+        dataB = find_phrases('./datasets/{}/test'.format(self.dataset_B_dir))
         labelA = [(1.0, 0.0) for _ in range(len(dataA))]
         labelB = [(0.0, 1.0) for _ in range(len(dataB))]
         data_origin = dataA + dataB
         label_origin = labelA + labelB
-        testing_list = [pair for pair in zip(data_origin, label_origin)]
         print('Successfully create testing list!')
 
-        data_test = [np.load(pair[0]) * 2. - 1. for pair in testing_list]
-        data_test = np.array(data_test).astype(np.float32)
-        gaussian_noise = np.random.normal(0,
-                                          self.sigma_c,
-                                          [data_test.shape[0],
-                                           data_test.shape[1],
-                                           data_test.shape[2],
-                                           data_test.shape[3]])
-        data_test += gaussian_noise
-        label_test = [pair[1] for pair in testing_list]
-        label_test = np.array(label_test).astype(np.float32).reshape(len(label_test), 2)
+        # the whole test set is decoded in parallel as a single batch
+        test_dataset = build_phrase_dataset(data_origin,
+                                            len(data_origin),
+                                            self.time_step,
+                                            self.pitch_range,
+                                            shuffle=False,
+                                            scale=2.,
+                                            shift=-1.,
+                                            drop_remainder=False)
+        data_test = next(iter(test_dataset))
+        # gaussian noise is drawn on device from the seeded generator
+        data_test += self.rng.normal(tf.shape(data_test),
+                                     mean=0.,
+                                     stddev=self.sigma_c)
+        label_test = np.array(label_origin).astype(np.float32).reshape(len(label_origin), 2)
 
         if args.continue_train:
-            if self.checkpoint.restore(self.checkpoint_manager.latest_checkpoint):
+            # all workers start from the chief's checkpoint
+            if self.checkpoint.restore(tf.train.latest_checkpoint(self.checkpoint_dir)):
                 print(" [*] Load checkpoint succeeded!")
             else:
                 print(" [!] Load checkpoint failed...")
 
+        # training phrases are shuffled, decoded in parallel and prefetched while the previous step is running,
+        # every data-parallel worker reads its own slice
+        dataset = build_phrase_dataset(data_train,
+                                       self.batch_size,
+                                       self.time_step,
+                                       self.pitch_range,
+                                       labels=label_train,
+                                       scale=2.,
+                                       shift=-1.,
+                                       num_shards=num_workers(),
+                                       shard_index=task_index())
+
+        # checkpoints are copied to host and written in the background
+        checkpoint_options = async_checkpoint_options()
+
+        # per step phase timings, throughput and peak memory
+        self.telemetry = StepTelemetry(os.path.join(args.log_dir, '{}_telemetry.jsonl'.format(self.model_dir)),
+                                       self.batch_size * num_workers(),
+                                       every=args.telemetry_every if is_chief() else 0)
+
+        if self.accum_steps > 1:
+            # gradients of accum_steps micro-batches are summed here before each optimizer update
+            accumulated_gradients = [tf.Variable(tf.zeros_like(v), trainable=False)
+                                     for v in self.classifier.trainable_variables]
+            print('Accumulating gradients over {} micro-batches of {}, effective batch size {}'.format(
+                self.accum_steps, self.batch_size, self.accum_steps * self.batch_size))
+
         counter = 1
 
         for epoch in range(args.epoch):
 
-            # shuffle the training samples
-            shuffle(training_list)
-
-            # get the correct batch number
-            batch_idx = len(training_list) // self.batch_size
+            # get the correct batch number, the same on every worker
+            batch_idx = len(data_train) // (self.batch_size * num_workers())
 
             # learning rate would decay after certain epochs
             self.lr = self.lr if epoch < args.epoch_step else self.lr * (args.epoch-epoch) / (args.epoch-args.epoch_step)
 
+            # the training samples are reshuffled every time the dataset is iterated
+            iterator = iter(dataset)
+
             for idx in range(batch_idx):
 
-                # data samples in batch
-                batch = training_list[idx * self.batch_size:(idx + 1) * self.batch_size]
-                batch_data = [np.load(pair[0]) * 2. - 1. for pair in batch]
-                batch_data = np.array(batch_data).astype(np.float32)
+                self.telemetry.begin_step()
+
+                with self.telemetry.phase('data'):
+                    batch = next(iterator, None)
+                if batch is None:
+                    break
+                batch_data, batch_label = batch
+
+                with self.telemetry.phase('forward_backward'):
+                    loss, test_accuracy, classifier_gradients = self.gradient_step(batch_data,
+                                                                                   batch_label,
+                                                                                   data_test,
+                                                                                   label_test)
 
-                # data labels in batch
-                batch_label = [pair[1] for pair in batch]
-                batch_label = np.array(batch_label).astype(np.float32).reshape(len(batch_label), 2)
+                if self.accum_steps > 1:
 
-                with tf.GradientTape(persistent=True) as tape:
+                    for buffer, gradient in zip(accumulated_gradients, classifier_gradients):
+                        buffer.assign_add(gradient)
 
-                    # Origin samples passed through the classifier
-                    origin = self.classifier(batch_data,
-                                             training=True)
-                    test = self.classifier(data_test,
-                                           training=True)
+                    # micro-batches left over at the end of an epoch are carried over to the next one
+                    if counter % self.accum_steps == 0:
+                        with self.telemetry.phase('apply_gradients'):
 
-                    # loss
-                    loss = softmax_criterion(origin, batch_label)
+                            # apply the averaged gradients to the optimizer, then clear the buffers
+                            self.strategy.run(self._apply_gradients,
+                                              args=([buffer / self.accum_steps for buffer in accumulated_gradients],))
+                            for buffer in accumulated_gradients:
+                                buffer.assign(tf.zeros_like(buffer))
 
-                    # test accuracy
-                    test_softmax = tf.nn.softmax(test)
-                    test_prediction = tf.equal(tf.argmax(test_softmax, 1), tf.argmax(label_test, 1))
-                    test_accuracy = tf.reduce_mean(tf.cast(test_prediction, tf.float32))
+                else:
 
-                # calculate gradients
-                classifier_gradients = tape.gradient(target=loss,
-                                                     sources=self.classifier.trainable_variables)
+                    with self.telemetry.phase('apply_gradients'):
 
-                # apply gradients to the optimizer
-                self.classifier_optimizer.apply_gradients(zip(classifier_gradients,
-                                                              self.classifier.trainable_variables))
+                        # apply gradients to the optimizer
+                        self.strategy.run(self._apply_gradients,
+                                          args=(classifier_gradients,))
 
                 if idx % 100 == 0:
 
@@ -176,49 +280,65 @@ class Classifier(object):
                     print(("Epoch: [%2d] [%4d/%4d] loss: %6.2f, accuracy: %6.2f" %
                            (epoch, idx, batch_idx, loss, test_accuracy)))
 
+                self.telemetry.end_step(counter,
+                                        epoch,
+                                        loss=loss,
+                                        accuracy=test_accuracy)
+
                 counter += 1
 
             print('=================================================================')
             print(("Epoch: [%2d] loss: %6.2f, accuracy: %6.2f" % (epoch, loss, test_accuracy)))
 
             # save the checkpoint per epoch
-            self.checkpoint_manager.save(epoch)
+            self.checkpoint_manager.save(epoch,
+                                         options=checkpoint_options)
+
+        # wait for the last checkpoint to reach the disk
+        if checkpoint_options is not None:
+            self.checkpoint.sync()
+        self.telemetry.close()
+        if not is_chief():
+            shutil.rmtree(worker_dir(self.checkpoint_dir), ignore_errors=True)
 
     def test(self, args):
 
         # load the origin samples in npy format and sorted in ascending order
-        sample_files_origin = glob('./test/{}2{}_{}_{}_{}/{}/npy/origin/*.*'.format(self.dataset_A_dir,
-                                                                                    self.dataset_B_dir,
-                                                                                    self.model,
-                                                                                    self.sigma_d,
-                                                                                    self.now_datetime,
-                                                                                    args.which_direction))
-        sample_files_origin.sort(key=lambda x: int(os.path.splitext(os.path.basename(x))[0].split('_')[0]))
+        sample_files_origin = find_phrases('./test/{}2{}_{}_{}_{}/{}/npy/origin'.format(self.dataset_A_dir,
+                                                                                       self.dataset_B_dir,
+                                                                                       self.model,
+                                                                                       self.sigma_d,
+                                                                                       self.now_datetime,
+                                                                                       args.which_direction))
+        if not isinstance(sample_files_origin, PhraseShards):
+            sample_files_origin.sort(key=lambda x: int(os.path.splitext(os.path.basename(x))[0].split('_')[0]))
 
         # load the origin samples in npy format and sorted in ascending order
-        sample_files_transfer = glob('./test/{}2{}_{}_{}_{}/{}/npy/transfer/*.*'.format(self.dataset_A_dir,
-                                                                                        self.dataset_B_dir,
-                                                                                        self.model,
-                                                                                        self.sigma_d,
-                                                                                        self.now_datetime,
-                                                                                        args.which_direction))
-        sample_files_transfer.sort(key=lambda x: int(os.path.splitext(os.path.basename(x))[0].split('_')[0]))
+        sample_files_transfer = find_phrases('./test/{}2{}_{}_{}_{}/{}/npy/transfer'.format(self.dataset_A_dir,
+                                                                                           self.dataset_B_dir,
+                                                                                           self.model,
+                                                                                           self.sigma_d,
+                                                                                           self.now_datetime,
+                                                                                           args.which_direction))
+        if not isinstance(sample_files_transfer, PhraseShards):
+            sample_files_transfer.sort(key=lambda x: int(os.path.splitext(os.path.basename(x))[0].split('_')[0]))
 
         # load the origin samples in npy format and sorted in ascending order
-        sample_files_cycle = glob('./test/{}2{}_{}_{}_{}/{}/npy/cycle/*.*'.format(self.dataset_A_dir,
-                                                                                  self.dataset_B_dir,
-                                                                                  self.model,
-                                                                                  self.sigma_d,
-                                                                                  self.now_datetime,
-                                                                                  args.which_direction))
-        sample_files_cycle.sort(key=lambda x: int(os.path.splitext(os.path.basename(x))[0].split('_')[0]))
+        sample_files_cycle = find_phrases('./test/{}2{}_{}_{}_{}/{}/npy/cycle'.format(self.dataset_A_dir,
+                                                                                     self.dataset_B_dir,
+                                                                                     self.model,
+                                                                                     self.sigma_d,
+                                                                                     self.now_datetime,
+                                                                                     args.which_direction))
+        if not isinstance(sample_files_cycle, PhraseShards):
+            sample_files_cycle.sort(key=lambda x: int(os.path.splitext(os.path.basename(x))[0].split('_')[0]))
 
         # put the origin, transfer and cycle of the same phrase in one zip
         sample_files = list(zip(sample_files_origin,
                                 sample_files_transfer,
                                 sample_files_cycle))
 
-        if self.checkpoint.restore(self.checkpoint_manager.latest_checkpoint):
+        if self.checkpoint.restore(self.checkpoint_manager.latest_checkpoint).expect_partial():
             print(" [*] Load checkpoint succeeded!")
         else:
             print(" [!] Load checkpoint failed...")
@@ -239,20 +359,17 @@ class Classifier(object):
         line_list = []
 
         for idx in range(len(sample_files)):
-            print('Classifying midi: ', sample_files[idx])
+            print('Classifying midi: ', phrase_name(sample_files_origin, idx))
 
-            # load sample phrases in npy formats
-            origin = np.load(sample_files[idx][0])
-            transfer = np.load(sample_files[idx][1])
-            cycle = np.load(sample_files[idx][2])
+            # load sample phrases in npy formats, or from the memory-mapped shards
+            origin = read_phrase(sample_files[idx][0])
+            transfer = read_phrase(sample_files[idx][1])
+            cycle = read_phrase(sample_files[idx][2])
 
             # get the probability for each sample phrase
-            origin_softmax = tf.nn.softmax(self.classifier(origin * 2. - 1.,
-                                                           training=False))
-            transfer_softmax = tf.nn.softmax(self.classifier(transfer * 2. - 1.,
-                                                             training=False))
-            cycle_softmax = tf.nn.softmax(self.classifier(cycle * 2. - 1.,
-                                                          training=False))
+            origin_softmax = self.classify(origin)
+            transfer_softmax = self.classify(transfer)
+            cycle_softmax = self.classify(cycle)
 
             origin_transfer_diff = np.abs(origin_softmax - transfer_softmax)
             content_diff = np.mean((origin * 1.0 - transfer * 1.0) ** 2)
@@ -324,13 +441,53 @@ class Classifier(object):
         accuracy_cycle = count_cycle * 1.0 / len(sample_files)
         print('Accuracy of this classifier on test datasets is :', accuracy_origin, accuracy_transfer, accuracy_cycle)
 
+    def quantize(self, args):
+        """int8 TFLite classifier calibrated on training phrases, with a drift report against float32 on test phrases"""
+        if self.checkpoint.restore(self.checkpoint_manager.latest_checkpoint).expect_partial():
+            print(" [*] Load checkpoint succeeded!")
+        else:
+            print(" [!] Load checkpoint failed...")
+
+        export_dir = os.path.join(args.export_dir, self.model_dir)
+        if not os.path.exists(export_dir):
+            os.makedirs(export_dir)
+
+        # both domains, the classifier has to separate them
+        calibration = np.concatenate([sample_phrases(find_phrases('./datasets/{}/train'.format(dataset_dir)),
+                                                     args.calibration_samples // 2,
+                                                     self.time_step,
+                                                     self.pitch_range)
+                                      for dataset_dir in [self.dataset_A_dir, self.dataset_B_dir]])
+        model_content = quantize_int8(self._classify, calibration, self.classifier)
+
+        path = os.path.join(export_dir, 'classifier_int8.tflite')
+        with open(path, 'wb') as f:
+            f.write(model_content)
+        print(' [*] Exported classifier to {}'.format(path))
+
+        # labels: 0 for A, 1 for B
+        test_phrases = [sample_phrases(find_phrases('./datasets/{}/test'.format(dataset_dir)),
+                                       args.calibration_samples // 2,
+                                       self.time_step,
+                                       self.pitch_range)
+                        for dataset_dir in [self.dataset_A_dir, self.dataset_B_dir]]
+        labels = np.concatenate([np.zeros(len(test_phrases[0])), np.ones(len(test_phrases[1]))])
+        report, float_scores, int8_scores = drift_report(self.classify,
+                                                         TFLiteModel(model_content),
+                                                         np.concatenate(test_phrases),
+                                                         args.test_batch_size,
+                                                         kind='classifier')
+        report['float32_accuracy'] = float((float_scores.argmax(-1) == labels).mean())
+        report['int8_accuracy'] = float((int8_scores.argmax(-1) == labels).mean())
+        write_report({'classifier': report}, export_dir)
+
     def test_famous(self, args):
 
         song_origin = np.load('./datasets/famous_songs/C2J/merged_npy/Scenes from Childhood (Schumann).npy')
         song_transfer = np.load('./datasets/famous_songs/C2J/transfer/Scenes from Childhood (Schumann).npy')
         print(song_origin.shape, song_transfer.shape)
 
-        if self.checkpoint.restore(self.checkpoint_manager.latest_checkpoint):
+        if self.checkpoint.restore(self.checkpoint_manager.latest_checkpoint).expect_partial():
             print(" [*] Load checkpoint succeeded!")
         else:
             print(" [!] Load checkpoint failed...")
@@ -344,13 +501,11 @@ class Classifier(object):
 
             phrase_origin = song_origin[idx]
             phrase_origin = phrase_origin.reshape(1, phrase_origin.shape[0], phrase_origin.shape[1], 1)
-            origin_softmax = tf.nn.softmax(self.classifier(phrase_origin * 2. - 1.,
-                                                           training=False))
+            origin_softmax = self.classify(phrase_origin)
 
             phrase_transfer = song_transfer[idx]
             phrase_transfer = phrase_transfer.reshape(1, phrase_transfer.shape[0], phrase_transfer.shape[1], 1)
-            transfer_softmax = tf.nn.softmax(self.classifier(phrase_transfer * 2. - 1.,
-                                                             training=False))
+            transfer_softmax = self.classify(phrase_transfer)
 
             sum_origin_A += origin_softmax[0][0]
             sum_origin_B += origin_softmax[0][1]
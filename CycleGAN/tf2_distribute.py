@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import tensorflow as tf
+
+
+def tf_config():
+    """Cluster description of this process, empty when it is not part of a multi-worker cluster"""
+    return json.loads(os.environ.get('TF_CONFIG', '{}'))
+
+
+def num_workers():
+    return len(tf_config().get('cluster', {}).get('worker', [])) or 1
+
+
+def task_index():
+    return tf_config().get('task', {}).get('index', 0)
+
+
+def is_chief():
+    # the first worker writes samples, checkpoints and logs
+    return task_index() == 0
+
+
+def worker_dir(path):
+    """path on the chief, a temporary directory under it on the other workers"""
+    if is_chief():
+        return path
+    return os.path.join(path, 'workertemp_{}'.format(task_index()))
+
+
+_strategy = None
+
+
+def setup_strategy():
+    """Create MultiWorkerMirroredStrategy when TF_CONFIG describes a cluster"""
+    global _strategy
+    if num_workers() > 1 and _strategy is None:
+        # has to run before any other op, the cluster is joined when the strategy is created
+        _strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    return get_strategy()
+
+
+def get_strategy():
+    """Strategy set up by setup_strategy, the single replica default strategy otherwise"""
+    return _strategy or tf.distribute.get_strategy()
+
+
+def launch_workers(num_workers, port=12345):
+    """Re-run this command as num_workers local processes joined into one multi-worker cluster"""
+    cluster = {'worker': ['localhost:{}'.format(port + index) for index in range(num_workers)]}
+    processes = []
+    for index in range(num_workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps({'cluster': cluster,
+                                                     'task': {'type': 'worker', 'index': index}}))
+        # progress is printed by the chief only, errors of every worker still reach stderr
+        processes.append(subprocess.Popen([sys.executable] + sys.argv,
+                                          env=env,
+                                          stdout=None if index == 0 else subprocess.DEVNULL))
+
+    # a failed worker would leave the others blocked in the all-reduce, so they are stopped as well
+    while any(process.poll() is None for process in processes):
+        if any(process.poll() for process in processes):
+            for process in processes:
+                if process.poll() is None:
+                    process.terminate()
+        time.sleep(1)
+
+    return max(abs(process.returncode) for process in processes)
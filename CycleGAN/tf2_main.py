@@ -1,7 +1,6 @@
 import argparse
 import os
-from tf2_model import CycleGAN
-from tf2_classifier import Classifier
+import sys
 
 parser = argparse.ArgumentParser(description='')
 parser.add_argument('--dataset_A_dir', dest='dataset_A_dir', default='CP_C', help='path of the dataset of domain A')
@@ -9,6 +8,17 @@ parser.add_argument('--dataset_B_dir', dest='dataset_B_dir', default='CP_P', hel
 parser.add_argument('--epoch', dest='epoch', type=int, default=10, help='# of epoch')
 parser.add_argument('--epoch_step', dest='epoch_step', type=int, default=10, help='# of epoch to decay lr')
 parser.add_argument('--batch_size', dest='batch_size', type=int, default=4, help='# images in batch')
+parser.add_argument('--accum_steps', dest='accum_steps', type=int, default=1, help='# of micro-batches whose gradients are accumulated before each update')
+parser.add_argument('--num_workers', dest='num_workers', type=int, default=1, help='# of local data-parallel training processes, ignored when TF_CONFIG is already set')
+parser.add_argument('--port', dest='port', type=int, default=12345, help='first localhost port used by the training processes')
+parser.add_argument('--xla', dest='xla', action='store_true', help='compile the train and inference steps with XLA')
+parser.add_argument('--recompute', dest='recompute', action='store_true', help='recompute the generator ResNet block activations in the backward pass instead of keeping them; on CPU with the full model about 40%% slower and 9%% less peak memory at batch size 16, no reliable saving at batch size 4')
+parser.add_argument('--precision', dest='precision', default='float32', choices=['float32', 'bfloat16'], help='compute precision of the networks, variables and losses stay in float32')
+parser.add_argument('--intra_op_threads', dest='intra_op_threads', type=int, default=0, help='# of threads used inside an op, 0 lets TensorFlow decide')
+parser.add_argument('--inter_op_threads', dest='inter_op_threads', type=int, default=0, help='# of ops run in parallel, 0 lets TensorFlow decide')
+parser.add_argument('--autotune_threads', dest='autotune_threads', action='store_true', help='probe a few thread pool sizes on this host and keep the fastest')
+parser.add_argument('--probe_batch_sizes', dest='probe_batch_sizes', default=None, help='comma separated batch sizes, print the training step time and peak memory of each and exit')
+parser.add_argument('--probe_steps', dest='probe_steps', type=int, default=0, help='time this many training steps on random phrases, print the result and exit')
 parser.add_argument('--time_step', dest='time_step', type=int, default=64, help='time step of pianoroll')
 parser.add_argument('--pitch_range', dest='pitch_range', type=int, default=84, help='pitch range of pianoroll')
 parser.add_argument('--ngf', dest='ngf', type=int, default=64, help='# of gen filters in first conv layer')
@@ -18,38 +28,117 @@ parser.add_argument('--output_nc', dest='output_nc', type=int, default=1, help='
 parser.add_argument('--lr', dest='lr', type=float, default=0.0002, help='initial learning rate for adam')
 parser.add_argument('--beta1', dest='beta1', type=float, default=0.5, help='momentum term of adam')
 parser.add_argument('--which_direction', dest='which_direction', default='AtoB', help='AtoB or BtoA')
-parser.add_argument('--phase', dest='phase', default='train', help='train, test')
+parser.add_argument('--phase', dest='phase', default='train', help='train, test, test_famous, serve, export, quantize, distill')
 parser.add_argument('--save_freq', dest='save_freq', type=int, default=1000, help='save a model every save_freq iterations')
 parser.add_argument('--print_freq', dest='print_freq', type=int, default=100, help='print the debug information every print_freq iterations')
 parser.add_argument('--continue_train', dest='continue_train', type=bool, default=False, help='if continue training, load the latest model: 1: true, 0: false')
+parser.add_argument('--max_pending_writes', dest='max_pending_writes', type=int, default=8, help='# of sample writes queued before training waits for the writer')
+parser.add_argument('--test_batch_size', dest='test_batch_size', type=int, default=64, help='# of phrases run through the generators at once in test')
+parser.add_argument('--write_workers', dest='write_workers', type=int, default=4, help='# of processes writing the test MIDI and npy files')
+parser.add_argument('--song_path', dest='song_path', default='./datasets/famous_songs/P2C/merged_npy/YMCA.npy', help='merged song transferred by test_famous')
+parser.add_argument('--song_overlap', dest='song_overlap', type=int, default=16, help='# of time steps shared by neighbouring windows of a song')
+parser.add_argument('--whole_song', dest='whole_song', action='store_true', help='transfer the song in one pass of a length-agnostic generator instead of in windows, memory grows with the song')
+parser.add_argument('--host', dest='host', default='127.0.0.1', help='address the serve phase listens on')
+parser.add_argument('--serve_port', dest='serve_port', type=int, default=8000, help='port the serve phase listens on')
+parser.add_argument('--max_delay_ms', dest='max_delay_ms', type=float, default=10., help='time a served request waits for others to share its batch')
+parser.add_argument('--cache_size', dest='cache_size', type=int, default=4096, help='# of transferred phrases kept in memory for repeated phrases, 0 disables it')
+parser.add_argument('--cache_dir', dest='cache_dir', default=None, help='also keep the transferred phrases in this directory across runs')
+parser.add_argument('--cache_dir_size', dest='cache_dir_size', type=int, default=65536, help='# of most recently used phrase files kept in cache_dir, 0 leaves it unbounded')
 parser.add_argument('--checkpoint_dir', dest='checkpoint_dir', default='./checkpoint', help='models are saved here')
 parser.add_argument('--sample_dir', dest='sample_dir', default='./samples', help='sample are saved here')
 parser.add_argument('--test_dir', dest='test_dir', default='./test', help='test sample are saved here')
+parser.add_argument('--export_dir', dest='export_dir', default='./export', help='generator weights for np_generator are exported here')
+parser.add_argument('--calibration_samples', dest='calibration_samples', type=int, default=256, help='# of training phrases calibrating the int8 quantization, and of test phrases in its drift report')
+parser.add_argument('--student_blocks', dest='student_blocks', type=int, default=3, help='# of ResNet blocks of the generator trained by the distill phase')
+parser.add_argument('--student_ngf', dest='student_ngf', type=int, default=32, help='# of gen filters in first conv layer of the distilled generator')
+parser.add_argument('--student_separable', dest='student_separable', action='store_true', help='depthwise-separable ResNet block convolutions in the distilled generator')
+parser.add_argument('--eval_samples', dest='eval_samples', type=int, default=256, help='# of test phrases in the distillation report')
 parser.add_argument('--log_dir', dest='log_dir', default='./log', help='logs are saved here')
+parser.add_argument('--telemetry_every', dest='telemetry_every', type=int, default=1, help='write step telemetry to log_dir every telemetry_every steps, 0 disables it')
+parser.add_argument('--telemetry_detail_every', dest='telemetry_detail_every', type=int, default=100, help='break the train step into forward, backward and apply every telemetry_detail_every steps, 0 disables it')
 parser.add_argument('--L1_lambda', dest='L1_lambda', type=float, default=10.0, help='weight on L1 term in objective')
 parser.add_argument('--gamma', dest='gamma', type=float, default=1.0, help='weight of extra discriminators')
 parser.add_argument('--max_size', dest='max_size', type=int, default=50, help='max size of image pool, 0 means do not use image pool')
 parser.add_argument('--sigma_c', dest='sigma_c', type=float, default=0.01, help='sigma of gaussian noise of classifiers')
 parser.add_argument('--sigma_d', dest='sigma_d', type=float, default=0.01, help='sigma of gaussian noise of discriminators')
+parser.add_argument('--seed', dest='seed', type=int, default=0, help='seed of the random generator used for noise and the image pool')
 parser.add_argument('--model', dest='model', default='full', help='three different models, base, partial, full')
 parser.add_argument('--type', dest='type', default='classifier', help='cyclegan or classifier')
 
 args = parser.parse_args()
 
 if __name__ == '__main__':
-    if not os.path.exists(args.checkpoint_dir):
-        os.makedirs(args.checkpoint_dir)
-    if not os.path.exists(args.sample_dir):
-        os.makedirs(args.sample_dir)
-    if not os.path.exists(args.test_dir):
-        os.makedirs(args.test_dir)
+    # imported here, the spawned processes writing test files load this module as __mp_main__
+    # and must not pay for TensorFlow just to unpickle their write_midi jobs
+    import tensorflow as tf
+    from tf2_model import CycleGAN
+    from tf2_classifier import Classifier
+    from tf2_distribute import launch_workers, setup_strategy
+    from tf2_benchmark import autotune_threads, thread_candidates, time_train_steps, probe_batch_sizes
+    from tf2_module import cpu_supports_bfloat16
+    from tf2_telemetry import peak_rss_mb
+    from tf2_server import serve
+
+    if args.autotune_threads:
+        argv = [arg for arg in sys.argv if arg != '--autotune_threads']
+        args.intra_op_threads, args.inter_op_threads = autotune_threads(argv, thread_candidates(args.num_workers))
+        print('Using intra_op_threads {} and inter_op_threads {}'.format(args.intra_op_threads, args.inter_op_threads))
+        # data-parallel workers are started with the tuned thread pools
+        sys.argv = argv + ['--intra_op_threads', str(args.intra_op_threads),
+                           '--inter_op_threads', str(args.inter_op_threads)]
+
+    if args.probe_batch_sizes:
+        # every batch size is probed in a process of its own, run with the other arguments
+        argv = [arg for i, arg in enumerate(sys.argv)
+                if not arg.startswith('--probe_batch_sizes') and sys.argv[i - 1] != '--probe_batch_sizes']
+        probe_batch_sizes(argv, [int(batch_size) for batch_size in args.probe_batch_sizes.split(',')])
+        sys.exit(0)
+
+    if args.phase == 'train' and args.num_workers > 1 and not args.probe_steps and 'TF_CONFIG' not in os.environ:
+        # this process only supervises the workers, each of them runs this script again with its TF_CONFIG
+        sys.exit(launch_workers(args.num_workers, args.port))
+
+    # thread pools have to be sized before TensorFlow runs its first op
+    tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
+    setup_strategy()
+
+    if args.precision == 'bfloat16' and cpu_supports_bfloat16() is False:
+        print(' [!] This CPU has no native bfloat16 support, bfloat16 is emulated and likely slower than float32')
+
+    if args.probe_steps:
+        print('probe_ms_per_step: {}'.format(time_train_steps(args, args.probe_steps)))
+        if peak_rss_mb() is not None:
+            print('probe_peak_rss_mb: {}'.format(peak_rss_mb()))
+        sys.exit(0)
+
+    # the data-parallel workers may create these at the same time
+    os.makedirs(args.checkpoint_dir, exist_ok=True)
+    os.makedirs(args.sample_dir, exist_ok=True)
+    os.makedirs(args.test_dir, exist_ok=True)
 
     if args.type == 'cyclegan':
         model = CycleGAN(args)
-        model.train(args) if args.phase == 'train' else model.test(args)
+        if args.phase == 'test_famous':
+            model.test_famous(args)
+        elif args.phase == 'serve':
+            serve(model, args)
+        elif args.phase == 'export':
+            model.export_generators(args)
+        elif args.phase == 'quantize':
+            model.quantize(args)
+        elif args.phase == 'distill':
+            model.distill(args)
+        else:
+            model.train(args) if args.phase == 'train' else model.test(args)
 
     if args.type == 'classifier':
 
         classifier = Classifier(args)
-        classifier.train(args) if args.phase == 'train' else classifier.test(args)
+        if args.phase == 'test_famous':
+            classifier.test_famous(args)
+        elif args.phase == 'quantize':
+            classifier.quantize(args)
+        else:
+            classifier.train(args) if args.phase == 'train' else classifier.test(args)
 
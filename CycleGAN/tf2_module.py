@@ -2,6 +2,7 @@ import numpy as np
 import tensorflow as tf
 from tensorflow.keras import Model, layers, Input
 from collections import namedtuple
+from contextlib import contextmanager
 
 
 def abs_criterion(pred, target):
@@ -20,77 +21,192 @@ def softmax_criterion(logits, labels):
     return tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits=logits, labels=labels))
 
 
+@contextmanager
+def precision_policy(precision='float32'):
+    """Networks built inside compute in precision ('float32' or 'bfloat16'), variables stay float32"""
+    previous = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy('mixed_bfloat16' if precision == 'bfloat16' else 'float32')
+    try:
+        yield
+    finally:
+        tf.keras.mixed_precision.set_global_policy(previous)
+
+
+def cpu_supports_bfloat16():
+    """True if the CPU has native bfloat16 instructions, None when it cannot be told"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read().split()
+    except IOError:
+        return None
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
 def padding(x, p=3):
     return tf.pad(x, [[0, 0], [p, p], [p, p], [0, 0]], "REFLECT")
 
+class ReflectPadConv2D(layers.Layer):
+    """Reflect padding and a 'valid' convolution grouped in one layer, owning the conv kernel"""
+
+    def __init__(self, filters, kernel_size, strides=1, kernel_initializer='glorot_uniform',
+                 activation=None, use_bias=False, separable=False, **kwargs):
+        super(ReflectPadConv2D, self).__init__(**kwargs)
+        self.filters = filters
+        self.kernel_size = kernel_size
+        self.strides = strides
+        # depthwise-separable: a per-channel k * k kernel followed by a 1 * 1 kernel mixing the channels
+        self.separable = separable
+        self.kernel_initializer = tf.keras.initializers.get(kernel_initializer)
+        self.activation = tf.keras.activations.get(activation)
+        self.use_bias = use_bias
+        # For kernel_size = 7, p = 3
+        self.p = (kernel_size - 1) // 2
+
+    def build(self, input_shape):
+        if self.separable:
+            self.depthwise_kernel = self.add_weight(name='depthwise_kernel',
+                                                    shape=(self.kernel_size, self.kernel_size, input_shape[-1], 1),
+                                                    initializer=self.kernel_initializer,
+                                                    trainable=True)
+            self.pointwise_kernel = self.add_weight(name='pointwise_kernel',
+                                                    shape=(1, 1, input_shape[-1], self.filters),
+                                                    initializer=self.kernel_initializer,
+                                                    trainable=True)
+        else:
+            self.kernel = self.add_weight(name='kernel',
+                                          shape=(self.kernel_size, self.kernel_size, input_shape[-1], self.filters),
+                                          initializer=self.kernel_initializer,
+                                          trainable=True)
+        if self.use_bias:
+            self.bias = self.add_weight(name='bias',
+                                        shape=(self.filters,),
+                                        initializer='zeros',
+                                        trainable=True)
+        super(ReflectPadConv2D, self).build(input_shape)
+
+    def call(self, x):
+        # the padded input is still materialised, tf.pad and the convolution run as two ops
+        if self.separable:
+            y = tf.nn.separable_conv2d(padding(x, self.p),
+                                       self.depthwise_kernel,
+                                       self.pointwise_kernel,
+                                       strides=[1, self.strides, self.strides, 1],
+                                       padding='VALID')
+        else:
+            y = tf.nn.conv2d(padding(x, self.p),
+                             self.kernel,
+                             strides=self.strides,
+                             padding='VALID')
+        if self.use_bias:
+            y = tf.nn.bias_add(y, self.bias)
+        return self.activation(y)
+
+    def get_config(self):
+        config = super(ReflectPadConv2D, self).get_config()
+        config.update({'filters': self.filters,
+                       'kernel_size': self.kernel_size,
+                       'strides': self.strides,
+                       'kernel_initializer': tf.keras.initializers.serialize(self.kernel_initializer),
+                       'activation': tf.keras.activations.serialize(self.activation),
+                       'use_bias': self.use_bias,
+                       'separable': self.separable})
+        return config
+
+
 class InstanceNorm(layers.Layer):
-    def __init__(self, epsilon=1e-5):
-        super(InstanceNorm, self).__init__()
+    def __init__(self, epsilon=1e-5, **kwargs):
+        # inputs are not cast to a bfloat16 compute dtype, the statistics are taken in float32
+        kwargs.setdefault('autocast', False)
+        super(InstanceNorm, self).__init__(**kwargs)
         self.epsilon = epsilon
-    
+
+    def build(self, input_shape):
+        # scale and offset are created once and reused by every call
+        self.scale = self.add_weight(name='SCALE',
+                                     shape=input_shape[-1:],
+                                     initializer=tf.random_normal_initializer(1., 0.02),
+                                     trainable=True,
+                                     experimental_autocast=False)
+        self.offset = self.add_weight(name='OFFSET',
+                                      shape=input_shape[-1:],
+                                      initializer='zeros',
+                                      trainable=True,
+                                      experimental_autocast=False)
+        super(InstanceNorm, self).build(input_shape)
+
     def call(self, x):
-        scale = tf.Variable(
-            initial_value=np.random.normal(1., 0.02, x.shape[-1:]),
-            trainable=True,
-            name='SCALE',
-            dtype=tf.float32
-        )
-        offset = tf.Variable(
-            initial_value=np.zeros(x.shape[-1:]),
-            trainable=True,
-            name='OFFSET',
-            dtype=tf.float32
-        )
+        x = tf.cast(x, tf.float32)
         mean, variance = tf.nn.moments(x, axes=[1, 2], keepdims=True)
         inv = tf.math.rsqrt(variance + self.epsilon)
         normalized = (x - mean) * inv
-        return scale * normalized + offset
+        return tf.cast(self.scale * normalized + self.offset, self.compute_dtype)
+
+    def get_config(self):
+        config = super(InstanceNorm, self).get_config()
+        config.update({'epsilon': self.epsilon})
+        return config
 
 
 class ResNetBlock(layers.Layer):
-    def __init__(self, dim, k_init, ks=3, s=1):
-        super(ResNetBlock, self).__init__()
+    def __init__(self, dim, k_init, ks=3, s=1, separable=False, recompute=False, **kwargs):
+        super(ResNetBlock, self).__init__(**kwargs)
         self.dim = dim 
         self.k_init = k_init 
         self.ks = ks
         self.s = s
-        self.p = (ks - 1) // 2
-        # For ks = 3, p = 1
-        self.padding = "valid"
+        self.separable = separable
+        # recompute: the block keeps only its input for the backward pass and runs itself again there
+        self.recompute = recompute
+
+    def build(self, input_shape):
+        # Sub-layers are created once here so that every call reuses the same weights
+        self.conv_1 = ReflectPadConv2D(filters=self.dim,
+                                       kernel_size=self.ks,
+                                       strides=self.s,
+                                       kernel_initializer=self.k_init,
+                                       use_bias=False,
+                                       separable=self.separable,
+                                       name='CONV2D_1')
+        self.norm_1 = InstanceNorm(name='INSTANCE_NORM_1')
+        self.conv_2 = ReflectPadConv2D(filters=self.dim,
+                                       kernel_size=self.ks,
+                                       strides=self.s,
+                                       kernel_initializer=self.k_init,
+                                       use_bias=False,
+                                       separable=self.separable,
+                                       name='CONV2D_2')
+        self.norm_2 = InstanceNorm(name='INSTANCE_NORM_2')
+        super(ResNetBlock, self).build(input_shape)
 
     def call(self, x):
-        y = layers.Lambda(padding, arguments={"p": self.p}, name="PADDING_1")(x)
-        # After first padding, (batch * 130 * 130 * 3)
-
-        y = layers.Conv2D(
-            filters=self.dim,
-            kernel_size=self.ks,
-            strides=self.s,
-            padding=self.padding,
-            kernel_initializer=self.k_init,
-            use_bias=False
-        )(y)
-        y = InstanceNorm()(y)
-        y = layers.ReLU()(y)
-        # After first conv2d, (batch * 128 * 128 * 3)
-
-        y = layers.Lambda(padding, arguments={"p": self.p}, name="PADDING_2")(y)
-        # After second padding, (batch * 130 * 130 * 3)
-
-        y = layers.Conv2D(
-            filters=self.dim,
-            kernel_size=self.ks,
-            strides=self.s,
-            padding=self.padding,
-            kernel_initializer=self.k_init,
-            use_bias=False
-        )(y)
-        y = InstanceNorm()(y)
-        y = layers.ReLU()(y + x)
-        # After second conv2d, (batch * 128 * 128 * 3)
+        # the first call builds the sub-layers, variables cannot be created under recompute_grad
+        if self.recompute and self.conv_2.built:
+            return tf.recompute_grad(self._block)(x)
+        return self._block(x)
+
+    def _block(self, x):
+        y = self.conv_1(x)
+        y = self.norm_1(y)
+        y = tf.nn.relu(y)
+        # After first padded conv2d, (batch * 16 * 21 * 256)
+
+        y = self.conv_2(y)
+        y = self.norm_2(y)
+        y = tf.nn.relu(y + x)
+        # After second padded conv2d, (batch * 16 * 21 * 256)
 
         return y
 
+    def get_config(self):
+        config = super(ResNetBlock, self).get_config()
+        config.update({'dim': self.dim,
+                       'k_init': tf.keras.initializers.serialize(self.k_init),
+                       'ks': self.ks,
+                       's': self.s,
+                       'separable': self.separable,
+                       'recompute': self.recompute})
+        return config
+
 def build_discriminator(options, name='Discriminator'):
 
     initializer = tf.random_normal_initializer(0., 0.02)
@@ -118,7 +234,7 @@ def build_discriminator(options, name='Discriminator'):
                       kernel_initializer=initializer,
                       use_bias=False,
                       name='CONV2D_2')(x)
-    x = InstanceNorm()(x)
+    x = InstanceNorm(name='INSTANCE_NORM_1')(x)
     x = layers.LeakyReLU(alpha=0.2)(x)
     # (batch * 16 * 21 * 256)
 
@@ -131,17 +247,25 @@ def build_discriminator(options, name='Discriminator'):
                       name='CONV2D_3')(x)
     # (batch * 16 * 21 * 1)
 
-    outputs = x
+    # outputs, and the losses computed from them, stay in float32 under a bfloat16 policy
+    outputs = tf.cast(x, tf.float32)
 
     return Model(inputs=inputs,
                  outputs=outputs,
                  name=name)
 
 
-def build_generator(options, name='Generator'):
+# the generator downsamples time and pitch twice by 2, inputs of any length have to be a multiple of this
+GENERATOR_STRIDE = 4
+
+
+def build_generator(options, name='Generator', n_blocks=10, separable=False, recompute=False):
+    # n_blocks and separable ResNet block convolutions size down a student generator, see CycleGAN.distill;
+    # recompute trades a second forward pass of the ResNet blocks for their activation memory in training
 
     initializer = tf.random_normal_initializer(0., 0.02)
 
+    # options.time_step None leaves the time dimension free, the network is fully convolutional
     inputs = Input(shape=(options.time_step,
                           options.pitch_range,
                           options.output_nc))
@@ -149,18 +273,14 @@ def build_generator(options, name='Generator'):
     x = inputs
     # (batch * 64 * 84 * 1)
 
-    x = layers.Lambda(padding,
-                      name='PADDING_1')(x)
-    # (batch * 70 * 90 * 1)
-
-    x = layers.Conv2D(filters=options.gf_dim,
-                      kernel_size=7,
-                      strides=1,
-                      padding='valid',
-                      kernel_initializer=initializer,
-                      use_bias=False,
-                      name='CONV2D_1')(x)
-    x = InstanceNorm()(x)
+    # Reflect padding to (batch * 70 * 90 * 1), then the convolution
+    x = ReflectPadConv2D(filters=options.gf_dim,
+                         kernel_size=7,
+                         strides=1,
+                         kernel_initializer=initializer,
+                         use_bias=False,
+                         name='CONV2D_1')(x)
+    x = InstanceNorm(name='INSTANCE_NORM_1')(x)
     x = layers.ReLU()(x)
     # (batch * 64 * 84 * 64)
 
@@ -171,7 +291,7 @@ def build_generator(options, name='Generator'):
                       kernel_initializer=initializer,
                       use_bias=False,
                       name='CONV2D_2')(x)
-    x = InstanceNorm()(x)
+    x = InstanceNorm(name='INSTANCE_NORM_2')(x)
     x = layers.ReLU()(x)
     # (batch * 32 * 42 * 128)
 
@@ -182,13 +302,17 @@ def build_generator(options, name='Generator'):
                       kernel_initializer=initializer,
                       use_bias=False,
                       name='CONV2D_3')(x)
-    x = InstanceNorm()(x)
+    x = InstanceNorm(name='INSTANCE_NORM_3')(x)
     x = layers.ReLU()(x)
     # (batch * 16 * 21 * 256)
 
-    for i in range(10):
+    for i in range(n_blocks):
         # x = resnet_block(x, options.gf_dim * 4)
-        x = ResNetBlock(dim=options.gf_dim * 4, k_init=initializer)(x)
+        x = ResNetBlock(dim=options.gf_dim * 4,
+                        k_init=initializer,
+                        separable=separable,
+                        recompute=recompute,
+                        name='RESNET_BLOCK_{}'.format(i + 1))(x)
     # (batch * 16 * 21 * 256)
 
     x = layers.Conv2DTranspose(filters=options.gf_dim * 2,
@@ -198,7 +322,7 @@ def build_generator(options, name='Generator'):
                                kernel_initializer=initializer,
                                use_bias=False,
                                name='DECONV2D_1')(x)
-    x = InstanceNorm()(x)
+    x = InstanceNorm(name='INSTANCE_NORM_4')(x)
     x = layers.ReLU()(x)
     # (batch * 32 * 42 * 128)
 
@@ -209,25 +333,22 @@ def build_generator(options, name='Generator'):
                                kernel_initializer=initializer,
                                use_bias=False,
                                name='DECONV2D_2')(x)
-    x = InstanceNorm()(x)
+    x = InstanceNorm(name='INSTANCE_NORM_5')(x)
     x = layers.ReLU()(x)
     # (batch * 64 * 84 * 64)
 
-    x = layers.Lambda(padding,
-                      name='PADDING_2')(x)
-    # After padding, (batch * 70 * 90 * 64)
-
-    x = layers.Conv2D(filters=options.output_nc,
-                      kernel_size=7,
-                      strides=1,
-                      padding='valid',
-                      kernel_initializer=initializer,
-                      activation='sigmoid',
-                      use_bias=False,
-                      name='CONV2D_4')(x)
+    # Reflect padding to (batch * 70 * 90 * 64), then the convolution
+    x = ReflectPadConv2D(filters=options.output_nc,
+                         kernel_size=7,
+                         strides=1,
+                         kernel_initializer=initializer,
+                         activation='sigmoid',
+                         use_bias=False,
+                         name='CONV2D_4')(x)
     # (batch * 64 * 84 * 1)
 
-    outputs = x
+    # outputs, and the losses computed from them, stay in float32 under a bfloat16 policy
+    outputs = tf.cast(x, tf.float32)
 
     return Model(inputs=inputs,
                  outputs=outputs,
@@ -262,7 +383,7 @@ def build_discriminator_classifier(options, name='Discriminator_Classifier'):
                       kernel_initializer=initializer,
                       use_bias=False,
                       name='CONV2D_2')(x)
-    x = InstanceNorm()(x)
+    x = InstanceNorm(name='INSTANCE_NORM_1')(x)
     x = layers.LeakyReLU(alpha=0.2)(x)
     # (batch * 16 * 7 * 128)
 
@@ -273,7 +394,7 @@ def build_discriminator_classifier(options, name='Discriminator_Classifier'):
                       kernel_initializer=initializer,
                       use_bias=False,
                       name='CONV2D_3')(x)
-    x = InstanceNorm()(x)
+    x = InstanceNorm(name='INSTANCE_NORM_2')(x)
     x = layers.LeakyReLU(alpha=0.2)(x)
     # (batch * 8 * 7 * 256)
 
@@ -284,7 +405,7 @@ def build_discriminator_classifier(options, name='Discriminator_Classifier'):
                       kernel_initializer=initializer,
                       use_bias=False,
                       name='CONV2D_4')(x)
-    x = InstanceNorm()(x)
+    x = InstanceNorm(name='INSTANCE_NORM_3')(x)
     x = layers.LeakyReLU(alpha=0.2)(x)
     # (batch * 1 * 7 * 512)
 
@@ -300,7 +421,8 @@ def build_discriminator_classifier(options, name='Discriminator_Classifier'):
     x = tf.reshape(x, [-1, 2])
     # (batch * 2)
 
-    outputs = x
+    # outputs, and the losses computed from them, stay in float32 under a bfloat16 policy
+    outputs = tf.cast(x, tf.float32)
 
     return Model(inputs=inputs,
                  outputs=outputs,
@@ -326,3 +448,9 @@ if __name__ == '__main__':
 
     model = build_generator(options)
     print(model.summary())
+
+    # every layer owns its weights, so calling the generator must not create new variables
+    num_variables = len(model.variables)
+    model(np.zeros((1, options.time_step, options.pitch_range, options.input_nc), dtype=np.float32))
+    assert len(model.variables) == num_variables
+    print('Generator variables:', num_variables)
@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import numpy as np
+import tensorflow as tf
+
+from tf2_shards import read_phrase
+
+
+def sample_phrases(phrases, num_samples, time_step=64, pitch_range=84, seed=0):
+    """Up to num_samples phrases of a find_phrases result, drawn without replacement, (num * 64 * 84 * 1)"""
+    idxs = np.random.RandomState(seed).choice(len(phrases), min(num_samples, len(phrases)), replace=False)
+    return np.stack([read_phrase(phrases[idx]) for idx in sorted(idxs)]).astype(np.float32).reshape(-1,
+                                                                                                  time_step,
+                                                                                                  pitch_range,
+                                                                                                  1)
+
+
+def quantize_int8(fn, calibration, trackable=None):
+    """TFLite flatbuffer of fn(phrases) with int8 weights and activations, ranges calibrated on calibration"""
+    phrase_spec = tf.TensorSpec(shape=[None] + list(calibration.shape[1:]), dtype=tf.float32)
+    concrete_fn = tf.function(fn).get_concrete_function(phrase_spec)
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete_fn], trackable)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = lambda: ([phrase[None]] for phrase in calibration)
+    # int8 kernels only, the float32 input and output are (de)quantized at the model boundary
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    return converter.convert()
+
+
+class TFLiteModel(object):
+    """Calls a TFLite flatbuffer with a single float32 input and output on batches of any size"""
+
+    def __init__(self, model_content, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_content=model_content,
+                                               num_threads=num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+
+    def __call__(self, inputs):
+        inputs = np.asarray(inputs, dtype=np.float32)
+        if len(inputs) != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, inputs.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(inputs)
+        self.interpreter.set_tensor(self.input_index, inputs)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index).copy()
+
+
+def run_batches(fn, phrases, batch_size=16):
+    # outputs and wall time per phrase in ms, after one untimed warm-up batch
+    np.asarray(fn(phrases[:batch_size]))
+    start_time = time.time()
+    outputs = np.concatenate([np.asarray(fn(phrases[start:start + batch_size]))
+                              for start in range(0, len(phrases), batch_size)])
+    return outputs, (time.time() - start_time) * 1000. / len(phrases)
+
+
+def drift_report(float_fn, int8_fn, phrases, batch_size=16, kind='transfer'):
+    """Output drift and speed of the int8 model against float32, kind is 'transfer' or 'classifier'"""
+    float_outputs, float_ms = run_batches(float_fn, phrases, batch_size)
+    int8_outputs, int8_ms = run_batches(int8_fn, phrases, batch_size)
+    error = np.abs(int8_outputs - float_outputs)
+    report = {'phrases': len(phrases),
+              'float32_ms_per_phrase': round(float_ms, 3),
+              'int8_ms_per_phrase': round(int8_ms, 3),
+              'speedup': round(float_ms / int8_ms, 3),
+              'mean_abs_error': float(error.mean()),
+              'max_abs_error': float(error.max())}
+
+    if kind == 'transfer':
+        # notes of the binarized piano rolls, as written to MIDI
+        float_notes = float_outputs > 0.5
+        int8_notes = int8_outputs > 0.5
+        both = np.logical_and(float_notes, int8_notes).sum()
+        report.update({'cell_agreement': float((float_notes == int8_notes).mean()),
+                       'note_f1': float(2. * both / max(float_notes.sum() + int8_notes.sum(), 1))})
+    else:
+        report.update({'top1_agreement': float((float_outputs.argmax(-1) == int8_outputs.argmax(-1)).mean())})
+    return report, float_outputs, int8_outputs
+
+
+def write_report(report, export_dir, name='quantization_report.json'):
+    print(json.dumps(report, indent=4))
+    with open(os.path.join(export_dir, name), 'w') as f:
+        json.dump(report, f, indent=4)
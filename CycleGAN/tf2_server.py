@@ -0,0 +1,209 @@
+import io
+import os
+import json
+import time
+import tempfile
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+
+from tf2_utils import save_midis, midi_to_roll, to_binary
+
+
+class _Request(object):
+    """Phrases of one HTTP request, filled in by the batching thread"""
+
+    def __init__(self, phrases):
+        self.phrases = phrases  # num_phrases * 64 * 84 * 1
+        self.outputs = np.zeros_like(phrases)
+        self.next = 0  # first phrase not yet handed to a batch
+        self.done = 0
+        self.error = None
+        self.event = threading.Event()
+        self.start_time = time.time()
+
+
+class DynamicBatcher(object):
+    """Runs the phrases of concurrent requests through step together, in batches of at most max_batch_size"""
+
+    def __init__(self, step, max_batch_size=64, max_delay_ms=10., history=1000):
+        self.step = step
+        self.max_batch_size = max_batch_size
+        # the first queued request waits at most max_delay_ms for others to share its batch
+        self.max_delay = max_delay_ms / 1000.
+        self.condition = threading.Condition()
+        self.queue = collections.deque()
+        self.latencies = collections.deque(maxlen=history)  # ms of the latest requests
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_phrases = 0
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def __call__(self, phrases):
+        request = _Request(phrases)
+        with self.condition:
+            self.queue.append(request)
+            self.condition.notify()
+        request.event.wait()
+        if request.error is not None:
+            raise request.error
+        with self.condition:
+            self.latencies.append((time.time() - request.start_time) * 1000.)
+            self.num_requests += 1
+        return request.outputs
+
+    def _queued_phrases(self):
+        return sum(len(request.phrases) - request.next for request in self.queue)
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.queue:
+                self.condition.wait()
+            deadline = self.queue[0].start_time + self.max_delay
+            while self._queued_phrases() < self.max_batch_size and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+
+            # (request, start, end) slices, a long request is spread over several batches
+            batch, size = [], 0
+            while self.queue and size < self.max_batch_size:
+                request = self.queue[0]
+                end = min(len(request.phrases), request.next + self.max_batch_size - size)
+                batch.append((request, request.next, end))
+                size += end - request.next
+                request.next = end
+                if end == len(request.phrases):
+                    self.queue.popleft()
+            return batch
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                outputs = np.asarray(self.step(np.concatenate([request.phrases[start:end]
+                                                               for request, start, end in batch])))
+            except Exception as e:
+                outputs = None
+                for request, _, _ in batch:
+                    request.error = e
+            offset = 0
+            for request, start, end in batch:
+                if outputs is not None:
+                    request.outputs[start:end] = outputs[offset:offset + end - start]
+                offset += end - start
+                request.done += end - start
+                if request.done == len(request.phrases) or request.error is not None:
+                    request.event.set()
+            with self.condition:
+                self.num_batches += 1
+                self.num_phrases += offset
+
+    def stats(self):
+        with self.condition:
+            latencies = np.array(self.latencies)
+            stats = {'queue_depth': len(self.queue),
+                     'queued_phrases': self._queued_phrases(),
+                     'requests': self.num_requests,
+                     'batches': self.num_batches,
+                     'mean_batch_size': self.num_phrases / max(self.num_batches, 1)}
+        for percentile in [50, 90, 99]:
+            stats['latency_p{}_ms'.format(percentile)] = \
+                float(np.percentile(latencies, percentile)) if len(latencies) else None
+        return stats
+
+
+def read_phrases(body, content_type, time_step=64, pitch_range=84):
+    """(num_phrases * 64 * 84 * 1) of an npy or MIDI payload, the last phrase is padded with silence"""
+    if content_type in ['audio/midi', 'audio/x-midi']:
+        roll = midi_to_roll(io.BytesIO(body))
+    else:
+        roll = np.load(io.BytesIO(body), allow_pickle=False)
+    roll = np.asarray(roll, dtype=np.float32).reshape(-1, pitch_range)  # num_steps * 84
+    num_phrases = max(-(-len(roll) // time_step), 1)
+    phrases = np.zeros((num_phrases * time_step, pitch_range), dtype=np.float32)
+    phrases[:len(roll)] = roll
+    return phrases.reshape(num_phrases, time_step, pitch_range, 1)
+
+
+def midi_bytes(phrases, tempo=80.):
+    """Encode (num_phrases * 64 * 84 * 1) as a single MIDI file"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'transfer.mid')
+        save_midis(to_binary(phrases, 0.5).numpy().astype(np.float32), path, tempo)
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+def serve(model, args):
+    """Serve POST /transfer/AtoB, POST /transfer/BtoA and GET /stats until interrupted"""
+    # the checkpoint is restored and the generators are traced once at startup, not per request
+    model.restore_latest_checkpoint()
+
+    batchers = {}
+    for direction in ['AtoB', 'BtoA']:
+        step = model._build_generator_step(direction)
+        step(np.zeros([1, model.time_step, model.pitch_range, model.input_c_dim], dtype=np.float32))
+
+        def cached_step(phrases, step=step, tag=model._cache_tag(direction)):
+            # repeated phrases are answered from the cache, without a generator call
+            return model.cache(lambda misses: (step(misses),), phrases, tag)[0]
+
+        batchers[direction] = DynamicBatcher(cached_step, args.test_batch_size, args.max_delay_ms)
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, body, content_type='application/json'):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, code, message):
+            self._reply(code, json.dumps({'error': message}).encode())
+
+        def do_GET(self):
+            if urlparse(self.path).path != '/stats':
+                return self._error(404, 'unknown path {}'.format(self.path))
+            stats = {direction: batcher.stats() for direction, batcher in batchers.items()}
+            stats['cache'] = model.cache.stats()
+            self._reply(200, json.dumps(stats).encode())
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            direction = url.path[len('/transfer/'):]
+            if not url.path.startswith('/transfer/') or direction not in batchers:
+                return self._error(404, 'use /transfer/AtoB or /transfer/BtoA')
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                phrases = read_phrases(body, self.headers.get('Content-Type'), model.time_step, model.pitch_range)
+            except Exception as e:
+                return self._error(400, 'cannot read the piano roll: {!r}'.format(e))
+
+            try:
+                transfer = batchers[direction](phrases)
+                # the transferred roll as npy with ?format=npy, MIDI otherwise
+                if query.get('format', ['midi'])[0] == 'npy':
+                    buffer = io.BytesIO()
+                    np.save(buffer, transfer)
+                    self._reply(200, buffer.getvalue(), 'application/octet-stream')
+                else:
+                    self._reply(200, midi_bytes(transfer, float(query.get('tempo', [80.])[0])), 'audio/midi')
+            except Exception as e:
+                self._error(500, repr(e))
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((args.host, args.serve_port), Handler)
+    server.daemon_threads = True
+    print(' [*] Serving on http://{}:{}'.format(args.host, args.serve_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
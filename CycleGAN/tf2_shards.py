@@ -0,0 +1,238 @@
+import os
+import re
+import json
+import argparse
+from glob import glob
+import numpy as np
+
+INDEX_NAME = 'index.json'
+
+
+def natural_key(path):
+    """Sort key that orders '2_origin.npy' before '10_origin.npy'"""
+    return [int(token) if token.isdigit() else token for token in re.split(r'(\d+)', os.path.basename(path))]
+
+
+def pack_rolls(rolls):
+    """Pack a batch of binary piano rolls (N, ...) into N rows of bits, one bit per cell"""
+    rolls = np.asarray(rolls)
+    return np.packbits(rolls.reshape(len(rolls), -1) > 0, axis=-1)
+
+
+def unpack_rolls(packed, shape, dtype=np.float32):
+    """Vectorised inverse of pack_rolls, returns a (N,) + shape batch"""
+    size = int(np.prod(shape))
+    bits = np.unpackbits(packed, axis=-1, count=size)
+    return bits.reshape((len(packed),) + tuple(shape)).astype(dtype)
+
+
+def save_packed_roll(path, roll):
+    """Store a single binary piano roll as an .npz holding its bits and shape"""
+    roll = np.asarray(roll)
+    np.savez(path, bits=pack_rolls(roll[None])[0], shape=np.array(roll.shape))
+
+
+def load_roll(path, dtype=np.float32):
+    """Load a piano roll saved either as a plain .npy or as a bit-packed .npz, dtype=None keeps it as stored"""
+    path = os.fsdecode(path)
+    if path.endswith('.npz'):
+        with np.load(path) as packed:
+            return unpack_rolls(packed['bits'][None], tuple(packed['shape']), dtype or np.uint8)[0]
+    roll = np.load(path)
+    return roll if dtype is None else roll.astype(dtype)
+
+
+def is_shard(path):
+    return os.path.isfile(os.path.join(path, INDEX_NAME))
+
+
+def write_shards(src_dir, out_dir, shard_size=16384, packed=False):
+    """Pack every phrase file of src_dir into contiguous .npy shards plus a json index"""
+    files = sorted(glob(os.path.join(src_dir, '*.np[yz]')), key=natural_key)
+    if not files:
+        raise ValueError('no .npy or .npz phrases found in {}'.format(src_dir))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    first = load_roll(files[0], dtype=None)
+    index = {'version': 1,
+             'shape': list(first.shape),
+             'dtype': first.dtype.str,
+             'packed': packed,
+             'shards': [],
+             'files': [os.path.basename(f) for f in files]}
+    # bit-packed shards hold one row of bits per phrase
+    row_shape = (len(pack_rolls(first[None])[0]),) if packed else first.shape
+    row_dtype = np.uint8 if packed else first.dtype
+
+    for shard_idx, start in enumerate(range(0, len(files), shard_size)):
+        shard_files = files[start:start + shard_size]
+        shard_name = 'shard_{:05d}.npy'.format(shard_idx)
+        # written through a memmap so that the whole corpus never has to fit in memory
+        shard = np.lib.format.open_memmap(os.path.join(out_dir, shard_name),
+                                          mode='w+',
+                                          dtype=row_dtype,
+                                          shape=(len(shard_files),) + row_shape)
+        for i, npy_file in enumerate(shard_files):
+            phrase = load_roll(npy_file, dtype=None).reshape(first.shape)
+            shard[i] = pack_rolls(phrase[None])[0] if packed else phrase
+        shard.flush()
+        del shard
+        index['shards'].append({'file': shard_name, 'offset': start, 'count': len(shard_files)})
+        print('Packed {} phrases into {}'.format(len(shard_files), shard_name))
+
+    with open(os.path.join(out_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+
+    return index
+
+
+class PhraseShards(object):
+    """Memory-mapped view over one or more packed shard directories"""
+
+    def __init__(self, paths):
+        if isinstance(paths, str):
+            paths = [paths]
+        self.paths = list(paths)
+        self.arrays = []
+        # every shard is decoded with the layout of its own index, packed and plain directories can be mixed
+        self.shapes = []
+        self.packed = []
+        self.files = []
+        for path in self.paths:
+            with open(os.path.join(path, INDEX_NAME)) as f:
+                index = json.load(f)
+            for shard in index['shards']:
+                self.arrays.append(np.load(os.path.join(path, shard['file']), mmap_mode='r'))
+                self.shapes.append(tuple(index['shape']))
+                self.packed.append(index.get('packed', False))
+            self.files += index['files']
+        # phrases are returned in the shape of the first directory
+        self.shape = self.shapes[0]
+        if any(np.prod(shape) != np.prod(self.shape) for shape in self.shapes):
+            raise ValueError('the shard directories {} hold phrases of different sizes'.format(self.paths))
+        self.offsets = np.cumsum([0] + [len(array) for array in self.arrays])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __add__(self, other):
+        if isinstance(other, PhraseShards):
+            return PhraseShards(self.paths + other.paths)
+        # a plain list of phrase files, e.g. one domain packed and the other not
+        return PhraseChain([self, other])
+
+    def __radd__(self, other):
+        return PhraseChain([other, self])
+
+    def _locate(self, indices):
+        shard_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+        return shard_ids, indices - self.offsets[shard_ids]
+
+    def __getitem__(self, idx):
+        # a single phrase is returned as a view into the memory-mapped shard
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('phrase index {} out of range'.format(idx))
+        shard_id, local_idx = self._locate(np.asarray(idx))
+        phrase = self.arrays[int(shard_id)][int(local_idx)]
+        if self.packed[int(shard_id)]:
+            return unpack_rolls(phrase[None], self.shape)[0]
+        return phrase.reshape(self.shape)
+
+    def batch(self, indices, dtype=np.float32):
+        """Gather the phrases at indices into one contiguous array"""
+        indices = np.asarray(indices, dtype=np.int64)
+        out = np.empty((len(indices),) + self.shape, dtype=dtype)
+        shard_ids, local_idx = self._locate(indices)
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            # reading in ascending order keeps the page cache access sequential
+            order = np.argsort(local_idx[mask])
+            rows = np.flatnonzero(mask)[order]
+            phrases = self.arrays[shard_id][local_idx[mask][order]]
+            if self.packed[shard_id]:
+                # the rows of a shard are unpacked in one vectorised call
+                phrases = unpack_rolls(phrases, self.shape, dtype)
+            out[rows] = phrases.reshape((len(rows),) + self.shape)
+        return out
+
+
+class PhraseChain(object):
+    """Concatenation of find_phrases results, packed shards and lists of phrase files alike"""
+
+    def __init__(self, parts):
+        self.parts = []
+        for part in parts:
+            self.parts += part.parts if isinstance(part, PhraseChain) else [part]
+        self.files = [phrase_name(part, idx) for part in self.parts for idx in range(len(part))]
+        self.offsets = np.cumsum([0] + [len(part) for part in self.parts])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __add__(self, other):
+        return PhraseChain([self, other])
+
+    def __radd__(self, other):
+        return PhraseChain([other, self])
+
+    def __getitem__(self, idx):
+        # a file path or a memory-mapped phrase, like the elements of find_phrases
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('phrase index {} out of range'.format(idx))
+        part_id = int(np.searchsorted(self.offsets, idx, side='right')) - 1
+        return self.parts[part_id][idx - int(self.offsets[part_id])]
+
+    def batch(self, indices, dtype=np.float32):
+        """Gather the phrases at indices into one contiguous array, flattened to (N * cells)"""
+        indices = np.asarray(indices, dtype=np.int64)
+        part_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+        out = [None] * len(indices)
+        for part_id in np.unique(part_ids):
+            rows = np.flatnonzero(part_ids == part_id)
+            part = self.parts[part_id]
+            local_idx = indices[rows] - self.offsets[part_id]
+            if isinstance(part, PhraseShards):
+                phrases = part.batch(local_idx, dtype)
+            else:
+                phrases = [load_roll(part[idx], dtype) for idx in local_idx]
+            for row, phrase in zip(rows, phrases):
+                out[row] = np.reshape(phrase, -1)
+        return np.stack(out).astype(dtype, copy=False)
+
+
+def find_phrases(path):
+    """Shard reader if path is a packed shard directory, otherwise the phrase files under it"""
+    if is_shard(path):
+        return PhraseShards(path)
+    return glob(os.path.join(path, '*.*'))
+
+
+def phrase_name(phrases, idx):
+    """File name of the idx-th element from find_phrases"""
+    if isinstance(phrases, (PhraseShards, PhraseChain)):
+        return phrases.files[idx]
+    return phrases[idx]
+
+
+def read_phrase(phrase):
+    """Load an element from find_phrases, either a file path or a memory-mapped phrase"""
+    if isinstance(phrase, str):
+        return load_roll(phrase)
+    return np.asarray(phrase)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Pack a directory of npy phrases into memory-mapped shards')
+    parser.add_argument('--src_dir', dest='src_dir', required=True, help='directory of npy phrases')
+    parser.add_argument('--out_dir', dest='out_dir', required=True, help='shard directory to write')
+    parser.add_argument('--shard_size', dest='shard_size', type=int, default=16384, help='# of phrases per shard')
+    parser.add_argument('--packed', dest='packed', action='store_true', help='store binary phrases with one bit per cell')
+    args = parser.parse_args()
+
+    write_shards(args.src_dir, args.out_dir, args.shard_size, args.packed)
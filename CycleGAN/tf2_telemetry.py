@@ -0,0 +1,93 @@
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return usage / 2. ** 20 if sys.platform == 'darwin' else usage / 2. ** 10
+
+
+def time_call(fn, *args):
+    """Wall time of fn(*args) in milliseconds"""
+    start_time = time.time()
+    fn(*args)
+    return (time.time() - start_time) * 1000.
+
+
+class StepTelemetry(object):
+    """Per-step phase timings, throughput and peak RSS appended to a JSON lines file"""
+
+    def __init__(self, log_path, batch_size, every=1, detail_every=0):
+        # every: record one step out of every, 0 disables telemetry
+        # detail_every: also break the train step into forward / backward / apply every detail_every steps
+        self.batch_size = batch_size
+        self.every = every
+        self.detail_every = detail_every
+        self.phases = {}
+        self.diagnostic_ms = 0.
+        self.step_start = time.time()
+        self.file = None
+        if self.every > 0:
+            if not os.path.exists(os.path.dirname(log_path)):
+                os.makedirs(os.path.dirname(log_path))
+            self.file = open(log_path, 'a')
+
+    def begin_step(self):
+        self.phases = {}
+        self.diagnostic_ms = 0.
+        self.step_start = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        start_time = time.time()
+        yield
+        self.add(name, (time.time() - start_time) * 1000.)
+
+    @contextmanager
+    def diagnostic(self):
+        # extra profiling passes, their time is left out of step_ms and samples_per_sec
+        start_time = time.time()
+        yield
+        self.diagnostic_ms += (time.time() - start_time) * 1000.
+
+    def add(self, name, ms):
+        self.phases[name] = self.phases.get(name, 0.) + ms
+
+    def should_record(self, step):
+        return self.file is not None and step % self.every == 0
+
+    def should_detail(self, step):
+        return self.file is not None and self.detail_every > 0 and step % self.detail_every == 0
+
+    def end_step(self, step, epoch, **values):
+        if not self.should_record(step):
+            return
+        step_ms = (time.time() - self.step_start) * 1000. - self.diagnostic_ms
+        record = {'time': time.time(),
+                  'epoch': epoch,
+                  'step': step,
+                  'step_ms': round(step_ms, 3),
+                  'samples_per_sec': round(self.batch_size / (step_ms / 1000.), 3),
+                  'diagnostic_ms': round(self.diagnostic_ms, 3),
+                  'peak_rss_mb': peak_rss_mb(),
+                  'phases': {name: round(ms, 3) for name, ms in self.phases.items()}}
+        record.update({key: float(value) for key, value in values.items()})
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -1,73 +1,217 @@
 import datetime
+import multiprocessing
+import concurrent.futures
+import queue
+import threading
 import numpy as np
-import copy
+import pretty_midi
 import write_midi
 import tensorflow as tf
+from tf2_shards import PhraseShards, PhraseChain, load_roll
 
 
 # new added functions for cyclegan
-class ImagePool(object):
+class ImagePool(tf.Module):
+    """History of generated (fake_A, fake_B) batches kept in a preallocated tensor buffer"""
 
-    def __init__(self, maxsize=50):
+    def __init__(self, maxsize=50, image_shape=None, rng=None, name='ImagePool'):
+        super(ImagePool, self).__init__(name=name)
         self.maxsize = maxsize
-        self.num_img = 0
-        self.images = []
+        self.rng = rng if rng is not None else tf.random.Generator.from_non_deterministic_state()
+        if self.maxsize > 0:
+            # 2 * (maxsize + 1) * batch_size * 64 * 84 * 1, for the fake_A and fake_B streams;
+            # the last slot is never read, it takes the writes of the samples that keep their own image
+            self.num_img = tf.Variable(0, dtype=tf.int32, trainable=False, name='num_img')
+            self.images = tf.Variable(tf.zeros([2, maxsize + 1] + list(image_shape)), trainable=False, name='images')
 
     def __call__(self, image):
         if self.maxsize <= 0:
             return image
-        if self.num_img < self.maxsize:
-            self.images.append(image)
-            self.num_img += 1
-            return image
-        if np.random.rand() > 0.5:
-            idx = int(np.random.rand()*self.maxsize)
-            tmp1 = copy.copy(self.images[idx])[0]
-            self.images[idx][0] = image[0]
-            idx = int(np.random.rand()*self.maxsize)
-            tmp2 = copy.copy(self.images[idx])[1]
-            self.images[idx][1] = image[1]
-            return [tmp1, tmp2]
-        else:
-            return image
+        image = tf.stack(image)  # 2 * batch_size * 64 * 84 * 1
+        image = tf.cond(self.num_img < self.maxsize,
+                        lambda: self._fill(image),
+                        lambda: self._swap(image))
+        return tf.unstack(image)
 
+    def _fill(self, image):
+        self.images.scatter_nd_update([[0, self.num_img], [1, self.num_img]], image)
+        self.num_img.assign_add(1)
+        return image
 
-def load_npy_data(npy_data):
-    npy_A = np.load(npy_data[0]) * 1.  # 64 * 84 * 1
-    npy_B = np.load(npy_data[1]) * 1.  # 64 * 84 * 1
-    npy_AB = np.concatenate((npy_A.reshape(npy_A.shape[0], npy_A.shape[1], 1),
-                             npy_B.reshape(npy_B.shape[0], npy_B.shape[1], 1)),
-                            axis=2)  # 64 * 84 * 2
-    return npy_AB
+    def _swap(self, image):
+        batch_size = tf.shape(image)[1]
+        # every sample of both streams independently returns a stored image with probability 0.5
+        # and takes its place in the history
+        use_history = self.rng.uniform([2, batch_size]) > 0.5
+        slots = self.rng.uniform([2, batch_size], maxval=self.maxsize, dtype=tf.int32)
+        streams, samples = tf.meshgrid(tf.range(2), tf.range(batch_size), indexing='ij')
+        indices = tf.stack([streams, slots, samples], axis=-1)  # 2 * batch_size * 3
 
+        history = tf.gather_nd(self.images.value(), indices)
+        # static shapes, so that the step can be compiled with XLA
+        scratch = tf.fill([2, batch_size], self.maxsize)
+        self.images.scatter_nd_update(tf.stack([streams, tf.where(use_history, slots, scratch), samples], axis=-1),
+                                      image)
+        mask = tf.reshape(use_history, [2, batch_size, 1, 1, 1])
+        return tf.where(mask, history, image)
 
-def save_midis(bars, file_path, tempo=80.0):
-    if bars.shape[2] == 84:
-        padded_bars = np.concatenate((np.zeros((bars.shape[0], bars.shape[1], 24, bars.shape[3])),
-                                    bars,
-                                    np.zeros((bars.shape[0], bars.shape[1], 20, bars.shape[3]))),
-                                    axis=2)
-    elif tf.is_tensor(bars):
-        padded_bars = bars.numpy()
+
+def load_npy_phrase(npy_path):
+    """Decode a single phrase file, plain or bit-packed, straight to float32"""
+    return load_roll(npy_path, np.float32)
+
+
+def build_phrase_dataset(data, batch_size, time_step=64, pitch_range=84, labels=None, shuffle=True,
+                         scale=1., shift=0., drop_remainder=True, num_shards=1, shard_index=0):
+    """Stream phrase files or packed shards as shuffled, batched and prefetched float32 tensors"""
+    # shards, and chains mixing shards with phrase files, are read by index
+    indexed = isinstance(data, (PhraseShards, PhraseChain))
+    if indexed:
+        # shards are indexed directly, a whole batch is gathered from the memory map at once
+        dataset = tf.data.Dataset.range(len(data))
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices(list(data))
+    if labels is not None:
+        dataset = tf.data.Dataset.zip((dataset,
+                                       tf.data.Dataset.from_tensor_slices(np.array(labels, dtype=np.float32))))
+    if num_shards > 1:
+        # every data-parallel worker reads a disjoint slice of the phrases
+        dataset = dataset.shard(num_shards, shard_index)
+    if shuffle:
+        # only the file names or indices are shuffled, which is cheap even for the whole dataset
+        dataset = dataset.shuffle(len(data), reshuffle_each_iteration=True)
+
+    if indexed:
+        dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+
+        def decode(indices):
+            phrases = tf.numpy_function(data.batch, [indices], tf.float32)
+            phrases = tf.reshape(phrases, [-1, time_step, pitch_range, 1])  # batch_size * 64 * 84 * 1
+            return phrases * scale + shift
+    else:
+        def decode(npy_path):
+            phrase = tf.numpy_function(load_npy_phrase, [npy_path], tf.float32)
+            phrase = tf.reshape(phrase, [time_step, pitch_range, 1])  # 64 * 84 * 1
+            return phrase * scale + shift
+
+    if labels is not None:
+        dataset = dataset.map(lambda phrase, label: (decode(phrase), label),
+                              num_parallel_calls=tf.data.AUTOTUNE)
     else:
-        padded_bars = bars
-    padded_bars = padded_bars.reshape(-1, 64, padded_bars.shape[2], padded_bars.shape[3])
-    padded_bars_list = []
-    for ch_idx in range(padded_bars.shape[3]):
-        padded_bars_list.append(padded_bars[:, :, :, ch_idx].reshape(padded_bars.shape[0],
-                                                                     padded_bars.shape[1],
-                                                                     padded_bars.shape[2]))
-    # this is for multi-track version
-    # write_midi.write_piano_rolls_to_midi(padded_bars_list, program_nums=[33, 0, 25, 49, 0],
-    #                                      is_drum=[False, True, False, False, False], filename=file_path, tempo=80.0)
-
-    # this is for single-track version
-    write_midi.write_piano_rolls_to_midi(piano_rolls=padded_bars_list,
-                                         program_nums=[0],
-                                         is_drum=[False],
-                                         filename=file_path,
-                                         tempo=tempo,
-                                         beat_resolution=4)
+        dataset = dataset.map(decode,
+                              num_parallel_calls=tf.data.AUTOTUNE)
+
+    if not indexed:
+        dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def save_midis(bars, file_path, tempo=80.0):
+    # tensors are copied to the host, the encoding itself is TensorFlow free, see write_midi.save_midis
+    write_midi.save_midis(bars.numpy() if tf.is_tensor(bars) else bars, file_path, tempo)
+
+
+def midi_to_roll(midi_file, tempo=None, beat_resolution=4):
+    """Binary (num_steps * 84) piano roll of a MIDI path or file object, the inverse of save_midis"""
+    midi = pretty_midi.PrettyMIDI(midi_file)
+    if tempo is None:
+        tempi = midi.get_tempo_changes()[1]
+        tempo = tempi[0] if len(tempi) else 120.
+    # beat_resolution steps per beat, all instruments merged into one track
+    roll = midi.get_piano_roll(fs=tempo / 60. * beat_resolution)  # 128 * num_steps
+    # the 84 pitches of the model, save_midis pads 24 below and 20 above
+    return (roll[24:108].T > 0).astype(np.float32)
+
+
+def song_windows(roll, time_step=64, overlap=0):
+    """Start step and (time_step * pitch_range * 1) window of a (num_steps * pitch_range) roll, overlap steps apart"""
+    hop = time_step - overlap
+    if hop <= 0:
+        raise ValueError('overlap must be smaller than the window of {} steps'.format(time_step))
+    for start in range(0, max(len(roll) - overlap, 1), hop):
+        window = np.zeros((time_step, roll.shape[1], 1), dtype=np.float32)
+        steps = roll[start:start + time_step]
+        window[:len(steps), :, 0] = steps  # the last window is padded with silence
+        yield start, window
+
+
+def crossfade_weights(time_step=64, overlap=0):
+    """Per step weights of a window, ramping up and down across the overlap with its neighbours"""
+    weights = np.ones(time_step, dtype=np.float32)
+    if overlap > 0:
+        # strictly positive, the song edges that only one window covers keep their own values
+        ramp = np.linspace(0., 1., overlap + 2, dtype=np.float32)[1:-1]
+        weights[:overlap] = ramp
+        weights[-overlap:] = ramp[::-1]
+    return weights
+
+
+class AsyncWriter(object):
+    """Runs file writing jobs on background threads, submit() blocks once max_pending jobs are queued"""
+
+    def __init__(self, max_pending=8, num_workers=1, processes=False):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        # MIDI encoding holds the GIL, with processes each thread hands its jobs to a worker process;
+        # the jobs then have to be picklable, module level functions
+        self.pool = None
+        if processes:
+            self.pool = concurrent.futures.ProcessPoolExecutor(num_workers,
+                                                               mp_context=multiprocessing.get_context('spawn'))
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            fn, args, kwargs = job
+            try:
+                if self.pool is None:
+                    fn(*args, **kwargs)
+                else:
+                    self.pool.submit(fn, *args, **kwargs).result()
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def _raise_errors(self):
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise RuntimeError('{} background write(s) failed, first error: {!r}'.format(len(errors), errors[0]))
+
+    def submit(self, fn, *args, **kwargs):
+        # the arguments must already be host copies, the caller may keep mutating its tensors
+        self._raise_errors()
+        self.queue.put((fn, args, kwargs))
+
+    def flush(self):
+        self.queue.join()
+        self._raise_errors()
+
+    def close(self):
+        # the threads and the process pool are stopped even if a write failed, its error is raised after
+        try:
+            self.flush()
+        finally:
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            if self.pool is not None:
+                self.pool.shutdown()
+
+
+def async_checkpoint_options():
+    """Checkpoint options that copy variables to host and write them in the background, when supported"""
+    try:
+        return tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+    except TypeError:
+        return None
 
 
 def get_now_datetime():
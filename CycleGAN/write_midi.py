@@ -183,4 +183,33 @@ def write_piano_rolls_to_midi(piano_rolls, program_nums=None, is_drum=None, file
         mido = generate_mido(instrument.notes)
         mido.save(temp_filename + '_track' + str(idx) + '.mid')
     # Write out the MIDI data
-    midi.write(filename)
\ No newline at end of file
+    midi.write(filename)
+
+
+def save_midis(bars, file_path, tempo=80.0):
+    """Write (num_phrases * 64 * pitches * tracks) bars to one MIDI file, 84 pitches are padded to 128"""
+    bars = np.asarray(bars)
+    if bars.shape[2] == 84:
+        padded_bars = np.concatenate((np.zeros((bars.shape[0], bars.shape[1], 24, bars.shape[3])),
+                                      bars,
+                                      np.zeros((bars.shape[0], bars.shape[1], 20, bars.shape[3]))),
+                                     axis=2)
+    else:
+        padded_bars = bars
+    padded_bars = padded_bars.reshape(-1, 64, padded_bars.shape[2], padded_bars.shape[3])
+    padded_bars_list = []
+    for ch_idx in range(padded_bars.shape[3]):
+        padded_bars_list.append(padded_bars[:, :, :, ch_idx].reshape(padded_bars.shape[0],
+                                                                     padded_bars.shape[1],
+                                                                     padded_bars.shape[2]))
+    # this is for multi-track version
+    # write_piano_rolls_to_midi(padded_bars_list, program_nums=[33, 0, 25, 49, 0],
+    #                           is_drum=[False, True, False, False, False], filename=file_path, tempo=80.0)
+
+    # this is for single-track version
+    write_piano_rolls_to_midi(piano_rolls=padded_bars_list,
+                              program_nums=[0],
+                              is_drum=[False],
+                              filename=file_path,
+                              tempo=tempo,
+                              beat_resolution=4)
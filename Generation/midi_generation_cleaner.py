@@ -195,6 +195,16 @@ def add_chord(notes, start_beat, length_in_beats, note_type=None):
         msgs.append(note_off)
     return msgs
 
+# Piano rolls are binary, so they are saved with one bit per cell: an .npz holding the packed
+# 'bits' and the roll 'shape' (the format read by CycleGAN/tf2_shards.load_roll)
+SAVE_PACKED_ROLLS = True
+
+def save_pianoroll(path, pianoroll):
+    if SAVE_PACKED_ROLLS:
+        np.savez(path.with_suffix('.npz'), bits=np.packbits(pianoroll.reshape(-1) > 0), shape=np.array(pianoroll.shape))
+    else:
+        np.save(path, pianoroll)
+
 def makefile(all_notes, savedir=None, filename=None):
     df = pd.DataFrame.from_records(all_notes)                                  # Assemble dataframe from list of dictionaries
     df.sort_values(by=['start_beat'], inplace=True)
@@ -313,7 +323,7 @@ def makefile(all_notes, savedir=None, filename=None):
         
         ### NEW PLAN: Assemble the npy array manually  
         # 256 timesteps (beat_resolution=16*16 beats) * 128 pitches 
-        pianoroll = np.zeros((256, 128))
+        pianoroll = np.zeros((256, 128), dtype=np.uint8)
         
         for tup in sdf_pianoroll.itertuples(): 
             pianoroll[tup[4]:tup[5], tup[1]] = 1 # Turn the note on for these timesteps 
@@ -338,22 +348,22 @@ def makefile(all_notes, savedir=None, filename=None):
         if (np.random.uniform(0,1) <= 0.8):
             if (('major' in filename) or ('dominant' in filename)):
                 #pretty_mid.write(str(savedir / 'major/train_midi' / mid_file))
-                np.save(savedir / 'major/train' / npy_file, pianoroll)
+                save_pianoroll(savedir / 'major/train' / npy_file, pianoroll)
                 mido_mid_recr.save(str(savedir / 'major/train_midi'/ mid_file2))
 
             else:    
                 #pretty_mid.write(str(savedir / 'minor/train_midi' / mid_file))
-                np.save(savedir / 'minor/train' / npy_file, pianoroll)
+                save_pianoroll(savedir / 'minor/train' / npy_file, pianoroll)
                 mido_mid_recr.save(str(savedir / 'minor/train_midi'/ mid_file2))
 
         else:
             if (('major' in filename) or ('dominant' in filename)):
                 #pretty_mid.write(str(savedir / 'major/test_midi' / mid_file))
-                np.save(savedir / 'major/test' / npy_file, pianoroll)
+                save_pianoroll(savedir / 'major/test' / npy_file, pianoroll)
                 mido_mid_recr.save(str(savedir / 'major/test_midi'/ mid_file2))
             else:
                 #pretty_mid.write(str(savedir / 'minor/test_midi' / mid_file))
-                np.save(savedir / 'minor/test' / npy_file, pianoroll)
+                save_pianoroll(savedir / 'minor/test' / npy_file, pianoroll)
                 mido_mid_recr.save(str(savedir / 'minor/test_midi'/ mid_file2))
     return None
 